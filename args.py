@@ -14,6 +14,8 @@ __all__ = [
     'read_action',
     'apply_action',
     'check_action',
+    'watch_action',
+    'signatures_action',
     'ArgsType'
 ]
 
@@ -23,6 +25,15 @@ class RootPathAction(argparse.Action):
         setattr(namespace, self.dest, Path(values).absolute())
 
 
+class StreamPathAction(RootPathAction):
+    # '-' is the standard input, read as a tar stream
+    def __call__(self, parser, namespace, values, option_string=None):
+        if values == '-':
+            setattr(namespace, self.dest, None)
+        else:
+            super().__call__(parser, namespace, values, option_string)
+
+
 cwd = Path(os.getcwd()).absolute()
 
 if os.name == 'nt':
@@ -47,6 +58,8 @@ status_action = action.add_parser('status')
 status_action.add_argument('-v', '--verbose', action='store_true', help='show whole tree')
 status_action.add_argument('-q', action='store_true', help="don't print files", dest='quiet')
 status_action.add_argument('-H', help='hide specific operations', dest='hide')
+status_action.add_argument('-l', '--list', action='store_true',
+                           help='list changed files as they are found instead of the tree')
 status_action.add_argument('--save', action='store_true',
                            help='save the current state of the target')
 
@@ -62,23 +75,40 @@ compare_action.add_argument('path', action=RootPathAction, default=cwd,
 save_action = action.add_parser('save')
 save_action.add_argument('-v', '--verbose', action='store_true', help='show whole tree')
 save_action.add_argument('-q', action='count', help="don't print files", dest='quiet')
-save_action.add_argument('-z', '--zip', help='save in zip file', action='store_true')
+save_format = save_action.add_mutually_exclusive_group()
+save_format.add_argument('-z', '--zip', help='save in zip file', action='store_true')
+save_format.add_argument('--tar', action='store_true',
+                         help='save in tar file, which `apply` reads in one pass, from a file or stdin')
 # save_action.add_argument('-C', help='include copies', action='store_true')
 save_action.add_argument('--base', action=RootPathAction, default=None,
                          help='base image to compare with')
+save_action.add_argument('--hardlink', action='store_true',
+                         help='hardlink files into the directory instead of copying them when it is on the same '
+                              'file system, they must not be changed in place until the diff is applied')
+save_action.add_argument('--signatures', action=RootPathAction, default=None,
+                         help='directory with block signatures from the destination, '
+                              'modified files are saved as deltas against them')
 save_action.add_argument('path', action=RootPathAction,
                          help='path to save the diff')
 
 check_action = action.add_parser('check')
 check_action.add_argument('-v', '--verbose', default=0, action='count', help='show all mismatches')
-check_action.add_argument('path', action=RootPathAction, default=cwd,
-                          help='path to save the diff or the directory with the diffs')
+check_action.add_argument('path', action=StreamPathAction, default=cwd,
+                          help='path to save the diff or the directory with the diffs, - for a tar from stdin')
 
 apply_action = action.add_parser('apply')
 apply_action.add_argument('-v', '--verbose', default=0, action='count', help='show all mismatches')
 apply_action.add_argument('--blind', action='store_true', help='ignore all errors and try to do the best ')
-apply_action.add_argument('path', action=RootPathAction, default=cwd,
-                          help='path to save the diff or the directory with the diffs')
+apply_action.add_argument('path', action=StreamPathAction, default=cwd,
+                          help='path to save the diff or the directory with the diffs, - for a tar from stdin')
+
+signatures_action = action.add_parser('signatures')
+signatures_action.add_argument('path', action=RootPathAction,
+                               help='directory to save the block signatures of large files for `save --signatures`')
+
+watch_action = action.add_parser('watch')
+watch_action.add_argument('--interval', type=float, default=60,
+                          help='seconds between saving the live image of changed targets')
 
 
 class ArgsType:
@@ -92,3 +122,8 @@ class ArgsType:
     save: bool
     path: Path
     zip: Path
+    tar: bool
+    hardlink: bool
+    interval: float
+    list: bool
+    signatures: Path
@@ -0,0 +1,44 @@
+# python -m bench.copy_file [size in mb] [folder]
+# the folder decides the file system, reflinks need btrfs, xfs or similar
+import os
+import shutil
+import sys
+import tempfile
+from time import perf_counter
+
+from util import human_readable_size
+from util.copy import copy_file, link_file, METHODS
+
+
+def measure(name, func, src, dest, size):
+    t = perf_counter()
+    func(src, dest)
+    dt = perf_counter() - t
+    os.unlink(dest)
+    print(f'{name:<18} {dt:.3f}s  {human_readable_size(size / dt)}/s')
+
+
+def main():
+    size = (int(sys.argv[1]) if len(sys.argv) > 1 else 512) * 1024 * 1024
+    with tempfile.TemporaryDirectory(dir=sys.argv[2] if len(sys.argv) > 2 else None) as folder:
+        src = os.path.join(folder, 'src')
+        dest = os.path.join(folder, 'dest')
+        with open(src, 'wb') as f:
+            for _ in range(size // (64 * 1024 * 1024)):
+                f.write(os.urandom(64 * 1024 * 1024))
+        measure('shutil.copy2', shutil.copy2, src, dest, size)
+        measure('copy_file', copy_file, src, dest, size)
+        measure('link_file', link_file, src, dest, size)
+        for method in METHODS:
+            def copy(src, dest):
+                with open(src, 'rb') as fsrc, open(dest, 'wb') as fdest:
+                    method(fsrc.fileno(), fdest.fileno(), size)
+            try:
+                measure(method.__name__, copy, src, dest, size)
+            except OSError as e:
+                print(f'{method.__name__:<18} {e.strerror}')
+                os.unlink(dest)
+
+
+if __name__ == '__main__':
+    main()
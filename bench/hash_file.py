@@ -0,0 +1,57 @@
+# python -m bench.hash_file [size_mb] [algorithm]
+import hashlib
+import os
+import sys
+import tempfile
+from time import perf_counter
+
+from util import human_readable_size
+from util.hashing import hash_file
+
+
+def hash_file_read(path):
+    # the previous implementation: a new 64 KiB bytes object for every read
+    BUF_SIZE = 65536
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(BUF_SIZE)
+            if not data:
+                break
+            sha1.update(data)
+    return sha1.digest()
+
+
+def measure(name, func, path, size, repeat=5):
+    best = None
+    for _ in range(repeat):
+        t = perf_counter()
+        res = func(path)
+        dt = perf_counter() - t
+        best = dt if best is None else min(best, dt)
+    print(f'{name:<12} {best:.3f}s  {human_readable_size(size / best)}/s')
+    return res
+
+
+def main():
+    size = int(sys.argv[1]) * 1024 * 1024 if len(sys.argv) > 1 else 512 * 1024 * 1024
+    algorithm = sys.argv[2] if len(sys.argv) > 2 else 'sha1'
+    with tempfile.NamedTemporaryFile(delete=False) as f:
+        block = os.urandom(1024 * 1024)
+        for _ in range(size // len(block)):
+            f.write(block)
+        path = f.name
+    try:
+        print(f'{human_readable_size(size)} file, {algorithm}, warm page cache')
+        results = set()
+        if algorithm == 'sha1':
+            results.add(measure('read', hash_file_read, path, size))
+        results.add(measure('readinto', lambda p: hash_file(p, algorithm, use_mmap=False), path, size))
+        results.add(measure('mmap', lambda p: hash_file(p, algorithm, use_mmap=True), path, size))
+        assert len(results) == 1
+    finally:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
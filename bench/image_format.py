@@ -0,0 +1,35 @@
+# python -m bench.image_format [files]
+import os
+import sys
+import tempfile
+from time import perf_counter
+
+from bench.image_memory import make_image, walk
+from image import FolderImage
+from util import RootPath, StructFile, COMPRESSION, human_readable_size
+
+
+def main():
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    image = make_image(files)
+    with tempfile.NamedTemporaryFile(suffix='.image', delete=False) as f:
+        path = f.name
+    try:
+        print(f'{files} files')
+        for compression in COMPRESSION:
+            with open(path, 'wb') as f:
+                t = perf_counter()
+                image.save(StructFile(f, path), compression)
+                save = perf_counter() - t
+            with open(path, 'rb') as f:
+                t = perf_counter()
+                walk(FolderImage.load(StructFile(f, path), RootPath('/bench')))
+                load = perf_counter() - t
+            print(f'{compression:<6} {human_readable_size(os.path.getsize(path)):>10}'
+                  f'   save {save:.2f}s   load {load:.2f}s')
+    finally:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
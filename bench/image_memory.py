@@ -0,0 +1,112 @@
+# python -m bench.image_memory [files]
+import os
+import sys
+import tempfile
+import tracemalloc
+from time import perf_counter
+
+from image import FileImage, FolderImage, FolderDiff, ColumnarImage
+from util import RootPath, StructFile, human_readable_size
+
+FILES_PER_FOLDER = 50
+FOLDERS_PER_FOLDER = 10
+
+
+def make_image(files: int) -> FolderImage:
+    root = RootPath('/bench')
+    folders = [FolderImage('', [], [])]
+    paths = [root]
+    i = 0
+    while i < files:
+        for j in range(FILES_PER_FOLDER):
+            folder, path = folders[-1], paths[-1]
+            name = f'file_{i}_{j}.dat'
+            folder.files.append(FileImage(name, path / name, 1_600_000_000 + i, i * 37 % 100_000, 1.6e9 + i,
+                                          os.urandom(20)))
+        i += FILES_PER_FOLDER
+        parent = len(folders) // FOLDERS_PER_FOLDER
+        folder = FolderImage(f'folder_{len(folders)}', [], [])
+        folders[parent].folders.append(folder)
+        folders.append(folder)
+        paths.append(paths[parent] / folder.name)
+    folders[0]._prune()
+    folders[0].hash_algorithm = 'sha1'
+    return folders[0]
+
+
+def walk(folder):
+    # lazily loaded folders are decoded too
+    for sub_folder in folder.folders:
+        walk(sub_folder)
+
+
+def measure(name, cls, path):
+    tracemalloc.start()
+    t = perf_counter()
+    with open(path, 'rb') as f:
+        image = cls.load(StructFile(f, path), RootPath('/bench'))
+        walk(image)
+    dt = perf_counter() - t
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{name:<10} {human_readable_size(size):>10}  {dt:.2f}s')
+    return image
+
+
+def measure_compare(name, cls, path, new: FolderImage):
+    # loading the old image and comparing the new one with it, as status and save do:
+    # the memory that stays with the diff and the peak while comparing
+    tracemalloc.start()
+    t = perf_counter()
+    with open(path, 'rb') as f:
+        old = cls.load(StructFile(f, path), RootPath('/bench'))
+    diff = FolderDiff.compare(new, old)
+    dt = perf_counter() - t
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{name:<10} {human_readable_size(size):>10}  peak {human_readable_size(peak):>10}  {dt:.2f}s')
+    return diff
+
+
+def changed_copy(path, every: int = 100) -> FolderImage:
+    # the saved image as the next scan sees it, with every `every`th file modified
+    with open(path, 'rb') as f:
+        image = FolderImage.load(StructFile(f, path), RootPath('/bench'))
+    for i, file in enumerate(image.iter_files()):
+        if i % every == 0:
+            file.mod += 1
+    image.hash_algorithm = 'sha1'
+    return image
+
+
+def main():
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    with tempfile.NamedTemporaryFile(suffix='.image', delete=False) as f:
+        make_image(files).save(StructFile(f, f.name))
+        path = f.name
+    try:
+        print(f'{files} files, {human_readable_size(os.path.getsize(path))} image file')
+        objects = measure('objects', FolderImage, path)
+        columns = measure('columns', ColumnarImage, path)
+
+        def key(file: FileImage):
+            return file.path, file.mod, file.size, file.created, file.hash
+
+        assert sorted(map(key, objects.iter_files())) == sorted(map(key, columns.iter_files()))
+        del objects, columns
+
+        print('compare, 1% of the files modified')
+        new = changed_copy(path)
+        diffs = [measure_compare(name, cls, path, new) for name, cls in (('objects', FolderImage),
+                                                                         ('columns', ColumnarImage))]
+
+        def statuses(diff: FolderDiff):
+            return sorted((file.status, str((file.new or file.old).path)) for file in diff.iter())
+
+        assert statuses(diffs[0]) == statuses(diffs[1])
+    finally:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+# python -m bench.struct_file [files]
+import os
+import struct
+import sys
+import tempfile
+from time import perf_counter
+
+from bench.image_memory import make_image, walk
+from image import FolderImage
+from util import RootPath, StructFile, human_readable_size
+
+
+def fields(s: struct.Struct):
+    # records were read and written field by field with native sizes, 'N' was only used for sizes
+    if not s.format.startswith('='):
+        return [s.format]
+    return ['N' if c == 'Q' else c for c in s.format[1:]]
+
+
+class UnbufferedStructFile(StructFile):
+    # the previous implementation: a file read or write and a format lookup for every field
+    def mapped(self):
+        return self
+
+    def tell(self):
+        return self.file.tell()
+
+    def size(self):
+        pos = self.file.tell()
+        size = self.file.seek(0, os.SEEK_END)
+        self.file.seek(pos)
+        return size
+
+    def read_struct(self, s: struct.Struct):
+        res = ()
+        for fmt in fields(s):
+            res += struct.unpack(fmt, self.file.read(struct.calcsize(fmt)))
+        return res
+
+    def read_bytes(self, n: int):
+        return self.file.read(n)
+
+    def write_struct(self, s: struct.Struct, *args):
+        formats = fields(s)
+        if len(formats) == 1:
+            self.file.write(s.pack(*args))
+            return
+        for fmt, arg in zip(formats, args):
+            self.file.write(struct.pack(fmt, arg))
+
+    def write_bytes(self, b: bytes):
+        self.file.write(b)
+
+    def write_uint(self, value: int):
+        super().write_uint(value)
+        self.flush()
+
+
+def measure(name, cls, image: FolderImage, path: str, repeat=3):
+    save = load = None
+    for _ in range(repeat):
+        with open(path, 'wb') as f:
+            t = perf_counter()
+            image.save(cls(f, path), 'none')  # compression would hide the cost of the I/O calls
+            dt = perf_counter() - t
+        save = dt if save is None else min(save, dt)
+        with open(path, 'rb') as f:
+            t = perf_counter()
+            walk(FolderImage.load(cls(f, path), RootPath('/bench')))
+            dt = perf_counter() - t
+        load = dt if load is None else min(load, dt)
+    size = os.path.getsize(path)
+    print(f'{name:<12} save {save:.2f}s {human_readable_size(size / save)}/s'
+          f'   load {load:.2f}s {human_readable_size(size / load)}/s')
+
+
+def main():
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    image = make_image(files)
+    with tempfile.NamedTemporaryFile(suffix='.image', delete=False) as f:
+        path = f.name
+    try:
+        print(f'{files} files')
+        measure('per field', UnbufferedStructFile, image, path)
+        measure('buffered', StructFile, image, path)
+    finally:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
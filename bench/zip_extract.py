@@ -0,0 +1,38 @@
+# python -m bench.zip_extract [size in mb]
+import os
+import shutil
+import sys
+import tempfile
+import zipfile
+from time import perf_counter
+
+from util import human_readable_size
+from util.hashing import MAX_BUF_SIZE
+
+
+def extract(archive: zipfile.ZipFile, dest: str, chunk: int):
+    with archive.open('data') as src, open(dest, 'wb') as out:
+        shutil.copyfileobj(src, out, chunk)
+
+
+def main():
+    size = (int(sys.argv[1]) if len(sys.argv) > 1 else 256) * 1024 * 1024
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'a.zip')
+        # half random, half zeros: deflated but not only trivially
+        block = os.urandom(MAX_BUF_SIZE // 2) + bytes(MAX_BUF_SIZE // 2)
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+            with archive.open('data', 'w', force_zip64=True) as f:
+                for _ in range(size // MAX_BUF_SIZE):
+                    f.write(block)
+        print(f'{human_readable_size(size)} member, {human_readable_size(os.path.getsize(path))} compressed')
+        with zipfile.ZipFile(path) as archive:
+            for chunk in (4096, 64 * 1024, MAX_BUF_SIZE):
+                t = perf_counter()
+                extract(archive, os.path.join(folder, 'out'), chunk)
+                dt = perf_counter() - t
+                print(f'{human_readable_size(chunk):>10} chunks  {dt:.2f}s  {human_readable_size(size / dt)}/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# python -m bench.zip_writer [files]
+import os
+import random
+import sys
+import tempfile
+import zipfile
+from time import perf_counter
+
+from util import human_readable_size
+from util.archive import ParallelZipWriter
+
+FILE_SIZE = 1024 * 1024
+
+
+def make_files(folder: str, files: int):
+    # half text-like data, half random data under media extensions
+    rng = random.Random(0)
+    words = [bytes(rng.choices(b'abcdefghijklmnopqrstuvwxyz', k=rng.randint(2, 10))) for _ in range(1000)]
+    paths = []
+    for i in range(files):
+        if i % 2:
+            path = os.path.join(folder, f'{i}.jpg')
+            data = os.urandom(FILE_SIZE)
+        else:
+            path = os.path.join(folder, f'{i}.txt')
+            data = b' '.join(rng.choices(words, k=FILE_SIZE // 6))[:FILE_SIZE]
+        with open(path, 'wb') as f:
+            f.write(data)
+        paths.append(path)
+    return paths
+
+
+def measure(name, paths, path, write):
+    t = perf_counter()
+    write(path)
+    dt = perf_counter() - t
+    print(f'{name:<10} {dt:.2f}s   {human_readable_size(os.path.getsize(path))}')
+
+
+def sequential(paths):
+    def write(path):
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for file in paths:
+                archive.write(file, os.path.basename(file))
+    return write
+
+
+def parallel(paths):
+    def write(path):
+        writer = ParallelZipWriter(zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED))
+        for file in paths:
+            writer.write(file, os.path.basename(file))
+        writer.close()
+    return write
+
+
+def main():
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    with tempfile.TemporaryDirectory() as folder:
+        paths = make_files(folder, files)
+        print(f'{files} files of {human_readable_size(FILE_SIZE)}, {os.cpu_count()} cores')
+        measure('ZipFile', paths, os.path.join(folder, 'a.zip'), sequential(paths))
+        measure('parallel', paths, os.path.join(folder, 'b.zip'), parallel(paths))
+        with zipfile.ZipFile(os.path.join(folder, 'b.zip')) as archive:
+            assert archive.testzip() is None
+
+
+if __name__ == '__main__':
+    main()
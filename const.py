@@ -1,17 +1,47 @@
+import os
 from typing import Tuple
 
 
 EasyHash = Tuple[str, int, int]
 
 SETTINGS_NAME = 'smolsync.json'
+BLOBS_NAME = 'blobs'  # data of files with a full hash in saved diffs, named by the hash
+DELTAS_NAME = 'deltas'  # deltas of modified files in saved diffs, by target and path
+STREAM_SUFFIXES = ('.tar', '.tar.gz', '.tgz')  # tar streams of `save --tar`, possibly compressed later
+
+DEFAULT_SCAN_WORKERS = 8
+DEFAULT_HASH_WORKERS = os.cpu_count() or 1
+DEFAULT_APPLY_WORKERS = 8
+DEFAULT_DELTA_MIN_SIZE = 64 * 1024 * 1024
 
 
 class Signatures:
-    IMAGE_SIGNATURE = b'smolimg '
-    DIFF_SIGNATURE = b'smoldiff'
-    HASH_STORAGE_SIGNATURE = b'smolhash'
+    IMAGE_SIGNATURE = b'smolimg6'
+    DIFF_SIGNATURE = b'smoldif6'
+    HASH_STORAGE_SIGNATURE = b'smolhsh4'
+    HASH_JOURNAL_SIGNATURE = b'smolhlg3'
+    BLOCKS_SIGNATURE = b'smolblk2'
+    DELTA_SIGNATURE = b'smoldlt2'
     LENGTH = 8
 
+    # format version of every signature that can still be read,
+    # version 1 has no header and always uses sha1
+    IMAGE_VERSIONS = {b'smolimg ': 1, b'smolimg2': 2, b'smolimg3': 3, b'smolimg4': 4, b'smolimg5': 5,
+                      IMAGE_SIGNATURE: 6}
+    DIFF_VERSIONS = {b'smoldiff': 1, b'smoldif2': 2, b'smoldif3': 3, b'smoldif4': 4, b'smoldif5': 5,
+                     DIFF_SIGNATURE: 6}
+    HASH_STORAGE_VERSIONS = {b'smolhash': 2, b'smolhsh2': 3, b'smolhsh3': 4, HASH_STORAGE_SIGNATURE: 5}
+
+    # first versions with a compact, optionally compressed body (see util.save_body)
+    IMAGE_COMPACT = 6
+    DIFF_COMPACT = 5
+    DIFF_BLOBS = 6  # and keep the data of files with a full hash in BLOBS_NAME
+    HASH_STORAGE_COMPACT = 5
+    HASH_JOURNAL_VERSIONS = {b'smolhlg2': 3, HASH_JOURNAL_SIGNATURE: 4}
+    # block signatures and deltas of util.delta, started with a header
+    BLOCKS_VERSIONS = {BLOCKS_SIGNATURE: 2}
+    DELTA_VERSIONS = {DELTA_SIGNATURE: 2}
+
 
 class SmolSyncException(Exception):
     pass
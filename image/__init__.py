@@ -2,3 +2,4 @@ from .file_image import FileImage
 from .file_diff import FileDiff
 from .folder_image import FolderImage
 from .folder_diff import FolderDiff
+from .columnar_image import ColumnarImage
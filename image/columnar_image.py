@@ -0,0 +1,238 @@
+from array import array
+from bisect import bisect_left
+from pathlib import Path, PurePath
+from typing import Container, Dict, Iterator, List, Optional, Union
+
+from const import Signatures
+from image.file_image import FileImage, RECORD, STAT_RECORD
+from util import RootPath, StructFile, load_header, load_body, LEGACY_HASH, HASH_NONE, HASH_FULL
+
+
+class ColumnarFolder:
+    # A folder of a ColumnarImage with the read-only interface of FolderImage,
+    # FileImage objects are created on access and aren't kept by the image
+
+    def __init__(self, image: 'ColumnarImage', index: int, path: Path):
+        self.image = image
+        self.index = index
+        self.path = path
+
+    @property
+    def name(self) -> str:
+        return self.image.names[self.image.folder_name[self.index]]
+
+    @property
+    def size(self) -> int:
+        return self.image.folder_size[self.index]
+
+    @property
+    def inode(self):
+        image = self.image
+        if not image.folder_has_inode[self.index]:
+            return None
+        return image.folder_dev[self.index], image.folder_ino[self.index], image.folder_mtime_ns[self.index]
+
+    def _file_range(self) -> range:
+        start = self.image.folder_files[self.index]
+        return range(start, start + self.image.folder_file_count[self.index])
+
+    def _folder_range(self) -> range:
+        start = self.image.folder_children[self.index]
+        return range(start, start + self.image.folder_child_count[self.index])
+
+    @property
+    def files(self) -> List[FileImage]:
+        return [self.image.file(i, self.path) for i in self._file_range()]
+
+    @property
+    def folders(self) -> List['ColumnarFolder']:
+        image = self.image
+        res = []
+        for i in self._folder_range():
+            folder = image.children[i]
+            res.append(ColumnarFolder(image, folder, self.path / image.names[image.folder_name[folder]]))
+        return res
+
+    def iter(self):
+        yield self
+        yield from self.files
+        for folder in self.folders:
+            yield from folder.iter()
+
+    def iter_files(self):
+        yield from self.files
+        for folder in self.folders:
+            yield from folder.iter_files()
+
+    def file_names(self) -> List[str]:
+        image = self.image
+        return [image.names[image.file_name[i]] for i in self._file_range()]
+
+    def iter_files_of_sizes(self, sizes: Container[int]) -> Iterator[FileImage]:
+        # iter_files without making objects of the files of other sizes
+        image = self.image
+        for i in self._file_range():
+            if image.file_size[i] in sizes:
+                yield image.file(i, self.path)
+        for folder in self.folders:
+            yield from folder.iter_files_of_sizes(sizes)
+
+    def _find_file(self, name: str) -> Optional[FileImage]:
+        image = self.image
+        files = self._file_range()
+        i = bisect_left(files, name, key=lambda i: image.names[image.file_name[i]])
+        if i < len(files) and image.names[image.file_name[files[i]]] == name:
+            return image.file(files[i], self.path)
+        return None
+
+    def _find_folder(self, name: str) -> Optional['ColumnarFolder']:
+        image = self.image
+        folders = self._folder_range()
+        i = bisect_left(folders, name, key=lambda i: image.names[image.folder_name[image.children[i]]])
+        if i < len(folders) and image.names[image.folder_name[image.children[folders[i]]]] == name:
+            return ColumnarFolder(image, image.children[folders[i]], self.path / name)
+        return None
+
+    def __getitem__(self, item: PurePath) -> Union[FileImage, 'ColumnarFolder', None]:
+        res = self
+        for part in item.parts:
+            if not isinstance(res, ColumnarFolder):
+                return None
+            found = res._find_file(part)
+            res = found if found is not None else res._find_folder(part)
+        return res
+
+
+class ColumnarImage(ColumnarFolder):
+    # FolderImage stored as columns: one array per field, names interned in one table,
+    # files and subfolders of a folder sorted by name. Folder 0 is the root
+    hash_algorithm: str = LEGACY_HASH
+
+    def __init__(self, path: Path, hash_size: int = 20):
+        super().__init__(self, 0, path)
+        self.hash_size = hash_size
+        self.names: List[str] = []
+        self._name_ids: Dict[str, int] = {}  # interns names while loading
+
+        self.file_name = array('I')
+        self.file_mod = array('I')
+        self.file_size = array('Q')
+        self.file_created = array('d')
+        self.file_tier = array('B')
+        self.file_hash = bytearray()  # hash_size bytes per file, zeros if there is no hash
+
+        self.folder_name = array('I')
+        self.folder_parent = array('I')
+        self.folder_size = array('Q')
+        self.folder_files = array('I')  # index of the first file of the folder
+        self.folder_file_count = array('I')
+        self.folder_children = array('I')  # index of the first subfolder in self.children
+        self.folder_child_count = array('I')
+        self.folder_has_inode = array('B')
+        self.folder_dev = array('Q')
+        self.folder_ino = array('Q')
+        self.folder_mtime_ns = array('q')
+        self.children = array('I')
+
+    def _intern(self, name: str) -> int:
+        name_id = self._name_ids.get(name)
+        if name_id is None:
+            name_id = self._name_ids[name] = len(self.names)
+            self.names.append(name)
+        return name_id
+
+    def file_unchanged(self, i: int, file: FileImage, compare_hash: bool = True) -> bool:
+        # the check of FileDiff for an unchanged file, against file i without making an object of it
+        if file.mod != self.file_mod[i] or file.size != self.file_size[i]:
+            return False
+        return not compare_hash or file.hash is None or file.hash_tier != self.file_tier[i] \
+            or file.hash == self.file_hash[i * self.hash_size:(i + 1) * self.hash_size]
+
+    def file(self, i: int, folder: Path) -> FileImage:
+        file = FileImage.__new__(FileImage)
+        file.name = self.names[self.file_name[i]]
+        file.path = folder._make_child_relpath(file.name)
+        file.mod = self.file_mod[i]
+        file.size = self.file_size[i]
+        file.created = self.file_created[i]
+        file.hash_tier = self.file_tier[i]
+        file.hash = bytes(self.file_hash[i * self.hash_size:(i + 1) * self.hash_size]) \
+            if file.hash_tier != HASH_NONE else None
+        file.partial_hash = None
+        file.copied_to = None
+        file.inode = None
+        return file
+
+    @classmethod
+    def load(cls, file: StructFile, path: RootPath) -> 'ColumnarImage':
+        # reads the same format as FolderImage.load
+        file = file.mapped()
+        algorithm = load_header(file, Signatures.IMAGE_VERSIONS, 'a smolsync image file')
+        if file.version >= Signatures.IMAGE_COMPACT:
+            file = load_body(file)
+        self = cls(path, file.hash_size)
+        self.hash_algorithm = algorithm
+        if file.version >= 5:
+            base = file.tell()
+            file.seek(file.size() - 8)
+            self._load_folder(file, 0, base, file.read('Q')[0])
+        else:
+            self._load_folder(file, 0)
+        self._name_ids.clear()  # only needed while loading
+        return self
+
+    def _load_folder(self, file: StructFile, parent: int, base: int = 0, offset: int = None) -> int:
+        if offset is not None:
+            file.seek(base + offset)
+        index = len(self.folder_name)
+        file.reset_context()
+        self.folder_name.append(self._intern(file.read_str()))
+        self.folder_parent.append(parent)
+        self.folder_size.append(file.read_num('N'))
+        if file.version >= 4 and file.read('?')[0]:
+            inode = (file.read_num('Q'), file.read_num('Q'), file.read_num('q'))
+        else:
+            inode = None
+        self.folder_has_inode.append(inode is not None)
+        for column, value in zip((self.folder_dev, self.folder_ino, self.folder_mtime_ns), inode or (0, 0, 0)):
+            column.append(value)
+
+        files = []
+        for _ in range(file.read_num('I')):
+            name = file.read_name()
+            if file.compact:
+                size = file.read_uint()
+                mod = file.read_delta('mod')
+                created = file.read_float_delta('created')
+                tier = file.read('B')[0]
+            elif file.version >= 3:
+                mod, size, created, tier = file.read_struct(RECORD)
+            else:
+                mod, size, created = file.read_struct(STAT_RECORD)
+                tier = HASH_FULL
+            file_hash = file.read_hash() if tier != HASH_NONE else bytes(file.hash_size)
+            files.append((name, mod, size, created, tier, file_hash))
+        files.sort(key=lambda f: f[0])
+        self.folder_files.append(len(self.file_name))
+        self.folder_file_count.append(len(files))
+        for name, mod, size, created, tier, file_hash in files:
+            self.file_name.append(self._intern(name))
+            self.file_mod.append(mod)
+            self.file_size.append(size)
+            self.file_created.append(created)
+            self.file_tier.append(tier)
+            self.file_hash += file_hash
+
+        self.folder_children.append(0)
+        self.folder_child_count.append(0)
+        dir_count = file.read_num('I')
+        if file.version >= 5:
+            offsets = [file.read_uint() for _ in range(dir_count)] if file.compact else file.read(f'{dir_count}Q')
+            children = [self._load_folder(file, index, base, offset) for offset in offsets]
+        else:
+            children = [self._load_folder(file, index) for _ in range(dir_count)]
+        children.sort(key=lambda i: self.names[self.folder_name[i]])
+        self.folder_children[index] = len(self.children)
+        self.folder_child_count[index] = len(children)
+        self.children.extend(children)
+        return index
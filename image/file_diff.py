@@ -1,12 +1,13 @@
 from pathlib import PurePosixPath
+from typing import Optional
 
 from util.struct_file import StructFile
-from util import RootPath
+from util import RootPath, HASH_FULL
 from image.file_image import FileImage
 
 
 class FileDiff:
-    def __init__(self, new: FileImage, old: FileImage):
+    def __init__(self, new: FileImage, old: FileImage, compare_hash: bool = True):
         self.new = new
         self.old = old
         if new is old:
@@ -15,7 +16,9 @@ class FileDiff:
             self.status = 'D'  # Deleted
         elif old is None:
             self.status = 'A'  # Added
-        elif new.mod != old.mod or new.size != old.size or new.hash is not None and new.hash != old.hash:
+        elif new.mod != old.mod or new.size != old.size \
+                or compare_hash and new.hash is not None and new.hash_tier == old.hash_tier \
+                and new.hash != old.hash:
             self.status = 'M'  # Modified
         # elif new.hash is None or old.hash is None:
         #     return '?'
@@ -43,6 +46,12 @@ class FileDiff:
     def is_modified(self):
         return self.status in {'A', 'M'}
 
+    def blob_name(self) -> Optional[str]:
+        # files with the same content share one copy of the data
+        if self.new is None or self.new.hash_tier != HASH_FULL:
+            return None
+        return self.new.hash.hex()
+
     @classmethod
     def load(cls, file: StructFile, folder: RootPath):
         self = cls.__new__(cls)
@@ -55,9 +64,7 @@ class FileDiff:
         elif self.status == 'C':
             self.new = FileImage.load(file, folder)
             self.old = self.new.copy_obj()
-            path = file.read_str()
-            path = PurePosixPath(*PurePosixPath(path).parts[1:])  # FIXME
-            self.old.path = folder.get_root() / PurePosixPath(path)
+            self.old.path = folder.get_root() / PurePosixPath(file.read_str())
         elif self.status == 'M':
             self.new = FileImage.load(file, folder)
             self.old = FileImage.load(file, folder)
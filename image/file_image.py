@@ -1,28 +1,37 @@
 import os
 import stat
 from pathlib import Path
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
 from const import EasyHash
-from util.struct_file import StructFile
-from util import RootPath, hash_file
+from util.struct_file import StructFile, record
+from util import RootPath, hash_file, DEFAULT_HASH, HASH_NONE, HASH_FULL
+
+STAT_RECORD = record('INd')  # mod, size, created
+RECORD = record('INdB')  # and the hash tier
 
 
 class FileImage:
-    def __init__(self, name, path: RootPath, mod, size, created, file_hash=None):
+    def __init__(self, name, path: RootPath, mod, size, created, file_hash=None, hash_tier=None):
         self.name = name
         self.path = path
         self.mod = int(mod)
         self.size = size
         self.created = created
         self.hash = file_hash
+        if hash_tier is None:
+            hash_tier = HASH_NONE if file_hash is None else HASH_FULL
+        self.hash_tier = hash_tier  # HASH_NONE, HASH_PARTIAL or HASH_FULL
+        self.partial_hash: Optional[bytes] = None  # kept from before a partial hash was upgraded to a full one
         self.copied_to: Optional[List[FileImage]] = None
+        self.inode: Optional[Tuple[int, int, int, int]] = None  # (st_dev, st_ino, st_mtime_ns, st_size) of a scanned file
 
     def copy_obj(self):
-        return FileImage(self.name, self.path, self.mod, self.size, self.created, self.hash)
+        return FileImage(self.name, self.path, self.mod, self.size, self.created, self.hash, self.hash_tier)
 
-    def calc_hash(self):
-        self.hash = hash_file(self.path)
+    def calc_hash(self, algorithm: str = DEFAULT_HASH):
+        self.hash = hash_file(self.path, algorithm)
+        self.hash_tier = HASH_FULL
 
     def easy_hash(self) -> EasyHash:
         return (self.created, self.mod, self.size)
@@ -38,24 +47,41 @@ class FileImage:
             file_stat = os.stat(path, follow_symlinks=False)
         if not stat.S_ISREG(file_stat.st_mode):
             raise None
-        return cls(path.name, path, file_stat.st_mtime, file_stat.st_size, file_stat.st_ctime, file_hash)
+        self = cls(path.name, path, file_stat.st_mtime, file_stat.st_size, file_stat.st_ctime, file_hash)
+        self.inode = (file_stat.st_dev, file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size)
+        return self
 
     @classmethod
     def load(cls, file: StructFile, dir: Path):
         self = cls.__new__(cls)
-        self.name = file.read_str()
-        self.path = dir / self.name
-        self.mod = file.read('I')[0]
-        self.size = file.read('N')[0]
-        self.created = file.read('d')[0]
-        self.hash = file.file.read(20)
+        self.name = file.read_name()
+        self.path = dir._make_child_relpath(self.name)  # `/` parses the name, which is most of the loading time
+        if file.compact:
+            self.size = file.read_uint()
+            self.mod = file.read_delta('mod')
+            self.created = file.read_float_delta('created')
+            self.hash_tier = file.read('B')[0]
+        elif file.version >= 3:
+            self.mod, self.size, self.created, self.hash_tier = file.read_struct(RECORD)
+        else:
+            self.mod, self.size, self.created = file.read_struct(STAT_RECORD)
+            self.hash_tier = HASH_FULL
+        self.hash = file.read_hash() if self.hash_tier != HASH_NONE else None
+        self.partial_hash = None
         self.copied_to = None
+        self.inode = None
         return self
 
     def save(self, file: StructFile):
-        file.write_str(self.name)
-        file.write('I', self.mod)
-        file.write('N', self.size)
-        file.write('d', self.created)
-        file.file.write(self.hash)
+        file.write_name(self.name)
+        if file.compact:
+            # files of a folder are usually written around the same time
+            file.write_uint(self.size)
+            file.write_delta('mod', self.mod)
+            file.write_float_delta('created', self.created)
+            file.write('B', self.hash_tier)
+        else:
+            file.write_struct(RECORD, self.mod, self.size, self.created, self.hash_tier)
+        if self.hash_tier != HASH_NONE:
+            file.write_hash(self.hash)
 
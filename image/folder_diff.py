@@ -1,20 +1,119 @@
 import itertools
 import os
-import shutil
+from collections import defaultdict
 from pathlib import PurePath
-from typing import List, Optional, Dict, Set, Callable, Iterable, Union
+from typing import List, Optional, Dict, Set, Callable, Iterable, Iterator, Union, TypeVar, Tuple
 
-from const import Signatures, EasyHash
-from util import RootPath, StructFile, check_signature, human_readable_size, print_tree_line
+from const import Signatures
+from util import RootPath, StructFile, load_header, save_header, load_body, save_body, human_readable_size, \
+    print_tree_line, LEGACY_HASH, HASH_NONE, HASH_PARTIAL, HASH_FULL
 from image.folder_image import FolderImage
 from image.file_image import FileImage
 from image.file_diff import FileDiff
-
-
-HashFileDict = Dict[EasyHash, FileImage]
+from image.columnar_image import ColumnarFolder
+from util.copy import copy_file
+
+
+StatKey = Tuple[int, int]
+HashFileDict = Dict[StatKey, FileImage]  # deleted files by mtime and size, a move changes the ctime
+ContentKey = Tuple[int, bytes]
+ContentDict = Dict[ContentKey, List[FileDiff]]  # deleted and unchanged files by their content
+
+T = TypeVar('T', FileImage, FolderImage)
+
+
+def content_key(file: FileImage) -> Optional[ContentKey]:
+    # only a full hash identifies the content
+    if file.hash_tier != HASH_FULL:
+        return None
+    return file.size, file.hash
+
+
+def same_hash(new: FileImage, old: FileImage) -> bool:
+    # a file with a hash can only be a copy of a file with the same one
+    if new.hash_tier == HASH_NONE:
+        return True
+    if new.hash_tier == old.hash_tier:
+        return new.hash == old.hash
+    return new.hash_tier == HASH_PARTIAL and old.partial_hash == new.hash
+
+
+def find_copy_source(file: FileDiff, deleted: HashFileDict, contents: ContentDict) -> Optional[FileImage]:
+    # a deleted file with the same content is moved rather than copied, then come deleted files
+    # with the same mtime and size, if the new file has no full hash, then unchanged files with the same content
+    key = content_key(file.new)
+    candidates = contents.get(key, []) if key is not None else []
+    for candidate in candidates:
+        if candidate.status == 'D':
+            return candidate.old
+    copied_from = deleted.get((file.new.mod, file.new.size))
+    if copied_from is not None and key is None and same_hash(file.new, copied_from):
+        return copied_from
+    if candidates:
+        return candidates[0].old
+    return None
+
+
+def sort_by_name(entries: List[T]) -> List[T]:
+    # images are saved sorted by name
+    if any(a.name > b.name for a, b in zip(entries, entries[1:])):
+        return sorted(entries, key=lambda x: x.name)
+    return entries
+
+
+def merge_names(new: List[str], old: List[str]) -> Iterator[Tuple[Optional[int], Optional[int]]]:
+    # pairs up the positions of the same names in two sorted lists, None for a name that one of them lacks
+    i = j = 0
+    while i < len(new) and j < len(old):
+        if new[i] == old[j]:
+            yield i, j
+            i += 1
+            j += 1
+        elif new[i] < old[j]:
+            yield i, None
+            i += 1
+        else:
+            yield None, j
+            j += 1
+    for i in range(i, len(new)):
+        yield i, None
+    for j in range(j, len(old)):
+        yield None, j
+
+
+def merge_by_name(new: List[T], old: List[T]) -> Iterator[Tuple[Optional[T], Optional[T]]]:
+    # pairs up entries with the same name
+    new, old = sort_by_name(new), sort_by_name(old)
+    for i, j in merge_names([x.name for x in new], [x.name for x in old]):
+        yield new[i] if i is not None else None, old[j] if j is not None else None
+
+
+def diff_files(new: Optional[FolderImage], old: Union[FolderImage, ColumnarFolder, None],
+               compare_hash: bool) -> Iterator[FileDiff]:
+    # the files of a ColumnarFolder are compared in its columns, objects are made only of those that changed
+    new_files = sort_by_name(new.files) if new else []
+    if not isinstance(old, ColumnarFolder):
+        for new_file, old_file in merge_by_name(new_files, old.files if old else []):
+            yield FileDiff(new_file, old_file, compare_hash)
+        return
+    image = old.image
+    indexes = old._file_range()
+    for i, j in merge_names([file.name for file in new_files], old.file_names()):
+        new_file = new_files[i] if i is not None else None
+        if new_file is None or j is None:
+            yield FileDiff(new_file, image.file(indexes[j], old.path) if j is not None else None, compare_hash)
+        elif image.file_unchanged(indexes[j], new_file, compare_hash) \
+                and (new_file.hash_tier == HASH_FULL or image.file_tier[indexes[j]] != HASH_FULL):
+            yield FileDiff(new_file, new_file)  # unchanged, like in a loaded diff
+        else:
+            # the old full hash finds copies of an unchanged file that isn't fully hashed now
+            yield FileDiff(new_file, image.file(indexes[j], old.path), compare_hash)
 
 
 class FolderDiff:
+    hash_algorithm: str = LEGACY_HASH  # only meaningful on the root folder
+    blobs: bool = True  # the data of hashed files is stored by blob_name, false for older diffs
+
     def __init__(self, name, folders: List['FolderDiff'], files: List[FileDiff]):
         self.name = name
         self.folders = folders
@@ -27,7 +126,7 @@ class FolderDiff:
         self._statuses = None
         self._dict: Optional[Dict[str, Union[FileImage, 'FolderImage']]] = None
 
-    def _calc_size(self):
+    def _calc_size(self, recursive: bool = False):
         self.copied_size = 0
         self.change_in_size = 0
         for file in self.files:
@@ -36,8 +135,8 @@ class FolderDiff:
             if file.status in {'M', 'A'}:
                 self.copied_size += file.new.size
         for folder in self.folders:
-            if not hasattr(folder, 'copied_size'):
-                folder._calc_size()
+            if recursive or not hasattr(folder, 'copied_size'):
+                folder._calc_size(recursive)
             self.copied_size += folder.copied_size
             self.change_in_size += folder.change_in_size
 
@@ -80,12 +179,27 @@ class FolderDiff:
 
     @classmethod
     def load(cls, file: StructFile, path: RootPath) -> 'FolderDiff':
-        check_signature(file, Signatures.DIFF_SIGNATURE, 'a smolsync diff file')
-        return cls._load(file, path, root=True)
+        file = file.mapped()
+        algorithm = load_header(file, Signatures.DIFF_VERSIONS, 'a smolsync diff file')
+        if file.version >= Signatures.DIFF_COMPACT:
+            file = load_body(file)
+        if file.version >= 4:
+            # subfolders are read from the mapped file when they are first accessed
+            base = file.tell()
+            file.seek(file.size() - 8)
+            self = cls._load(file, path, root=True, base=base, offset=file.read('Q')[0])
+        else:
+            self = cls._load(file, path, root=True)
+        self.hash_algorithm = algorithm
+        self.blobs = file.version >= Signatures.DIFF_BLOBS
+        return self
 
     @classmethod
-    def _load(cls, file: StructFile, path: RootPath, root=False):
+    def _load(cls, file: StructFile, path: RootPath, root=False, base: int = 0, offset: int = None):
+        if offset is not None:
+            file.seek(base + offset)
         self = cls.__new__(cls)
+        file.reset_context()
         self.name = file.read_str()
         if root:
             self.name = ''
@@ -94,32 +208,62 @@ class FolderDiff:
         self._has_changes = None
         self._statuses = None
         self._dict = None
-        self.copied_size = file.read('q')[0]
-        self.change_in_size = file.read('q')[0]
-        files_count = file.read('I')[0]
+        self.copied_size = file.read_num('q')
+        self.change_in_size = file.read_num('q')
+        if file.version >= 4:
+            # known without reading the subfolders
+            self._statuses = set(file.read_str())
+            self._has_changes = len(self._statuses) != 0
+            self._has_modified = not self._statuses.isdisjoint('AM')
+        files_count = file.read_num('I')
         self.files = []
         for _ in range(files_count):
             self.files.append(FileDiff.load(file, path))
-        dir_count = file.read('I')[0]
-        self.folders = []
-        for _ in range(dir_count):
-            self.folders.append(cls._load(file, path))
+        dir_count = file.read_num('I')
+        if file.version >= 4:
+            self._folders = []
+            offsets = [file.read_uint() for _ in range(dir_count)] if file.compact else file.read(f'{dir_count}Q')
+            self._lazy = (file, path, base, offsets)
+        else:
+            self.folders = [cls._load(file, path) for _ in range(dir_count)]
         return self
 
-    def save(self, file: StructFile):
-        file.write_bytes(Signatures.DIFF_SIGNATURE)
-        self._save(file)
-
-    def _save(self, file: StructFile):
+    @property
+    def folders(self) -> List['FolderDiff']:
+        if self._lazy is not None:
+            file, path, base, offsets = self._lazy
+            self._lazy = None
+            self._folders = [self._load(file, path, base=base, offset=offset) for offset in offsets]
+        return self._folders
+
+    @folders.setter
+    def folders(self, folders: List['FolderDiff']):
+        self._folders = folders
+        self._lazy = None
+
+    def save(self, file: StructFile, compression: str = 'zlib'):
+        save_header(file, Signatures.DIFF_SIGNATURE, self.hash_algorithm)
+        save_body(file, compression)
+        base = file.tell()
+        file.write('Q', self._save(file, base))
+        file.finish()
+
+    def _save(self, file: StructFile, base: int) -> int:
+        # laid out like FolderImage: subfolders first, the offset of the root at the end
+        offsets = [folder._save(file, base) for folder in self.folders]
+        offset = file.tell() - base
+        file.reset_context()
         file.write_str(self.name)
-        file.write('q', self.copied_size)
-        file.write('q', self.change_in_size)
-        file.write('I', len(self.files))
+        file.write_num('q', self.copied_size)
+        file.write_num('q', self.change_in_size)
+        file.write_str(''.join(sorted(self.statuses())))
+        file.write_num('I', len(self.files))
         for file_diff in self.files:
             file_diff.save(file)
-        file.write('I', len(self.folders))
-        for folder in self.folders:
-            folder._save(file)
+        file.write_num('I', len(offsets))
+        for child_offset in offsets:
+            file.write_num('Q', child_offset)
+        return offset
 
     def connect_copied_by_path(self, root):
         for file in self.files:
@@ -131,55 +275,85 @@ class FolderDiff:
             folder.connect_copied_by_path(root)
 
     @classmethod
-    def compare(cls, new: FolderImage, old: FolderImage, hash_files: bool = False) -> 'FolderDiff':
-        self = cls._compare(new, old, hash_files)
+    def compare(cls, new: FolderImage, old: FolderImage) -> 'FolderDiff':
+        # hashes of different algorithms can't be compared, so only mtime and size are used then
+        self = cls._compare(new, old, new.hash_algorithm == old.hash_algorithm)
+        self.hash_algorithm = new.hash_algorithm
         deleted = {}
-        self._collect_deleted(deleted)
-        self._set_copied(deleted)
-        self._calc_size()
+        contents = defaultdict(list)
+        self._collect_deleted(deleted, contents if new.hash_algorithm == old.hash_algorithm else None)
+        self._set_copied(deleted, contents)
+        self._calc_size(recursive=True)  # copies aren't copied_size any more
         return self
 
-    def _collect_deleted(self, deleted: HashFileDict):
+    @staticmethod
+    def _collect_file(file: FileDiff, deleted: HashFileDict, contents: Optional[ContentDict]):
+        if file.status == 'D':
+            deleted.setdefault((file.old.mod, file.old.size), file.old)
+        if contents is not None and file.status in {'D', '-'}:
+            key = content_key(file.old)
+            if key is None and file.new is not None:
+                key = content_key(file.new)  # unchanged files may have been hashed only now
+            if key is not None:
+                contents[key].append(file)
+
+    def _collect_deleted(self, deleted: HashFileDict, contents: Optional[ContentDict]):
         for file in self.files:
-            if file.status == 'D':
-                deleted[file.old.easy_hash()] = file.old
+            self._collect_file(file, deleted, contents)
         for folder in self.folders:
-            folder._collect_deleted(deleted)
+            folder._collect_deleted(deleted, contents)
 
-    def _set_copied(self, deleted: HashFileDict):
+    def _set_copied(self, deleted: HashFileDict, contents: ContentDict):
         for file in self.files:
             if file.status == 'A':
-                copied_from = deleted.get(file.new.easy_hash())
+                copied_from = find_copy_source(file, deleted, contents)
                 if copied_from is not None:
                     file.set_copied(copied_from)
         for folder in self.folders:
-            folder._set_copied(deleted)
+            folder._set_copied(deleted, contents)
 
     @classmethod
-    def _compare(cls, new: FolderImage, old: FolderImage, hash_files: bool = False) -> 'FolderDiff':
+    def _compare(cls, new: FolderImage, old: FolderImage, compare_hash: bool = True) -> 'FolderDiff':
         name = new.name if new else old.name
-        if new is None:
-            new = FolderImage(name, [], [])
-        if old is None:
-            old = FolderImage(name, [], [])
-
-        files = {file.name: [file, None] for file in new.files}
-        for file in old.files:
-            if file.name in files:
-                files[file.name][1] = file
-            else:
-                files[file.name] = [None, file]
-        file_diffs = [FileDiff(file[0], file[1]) for file in files.values()]
-
-        folders = {folder.name: [folder, None] for folder in new.folders}
-        for folder in old.folders:
-            if folder.name in folders:
-                folders[folder.name][1] = folder
-            else:
-                folders[folder.name] = [None, folder]
-        folder_diffs = [FolderDiff._compare(folder[0], folder[1], hash_files) for folder in folders.values()]
+        file_diffs = list(diff_files(new, old, compare_hash))
+        folder_diffs = [cls._compare(new_folder, old_folder, compare_hash)
+                        for new_folder, old_folder in merge_by_name(new.folders if new else [],
+                                                                    old.folders if old else [])]
         return cls(name, folder_diffs, file_diffs)
 
+    @classmethod
+    def iter_compare(cls, new: Optional[FolderImage], old: Optional[FolderImage],
+                     compare_hash: bool = True) -> Iterator[FileDiff]:
+        # the same comparison as _compare, one file at a time without building the tree
+        yield from diff_files(new, old, compare_hash)
+        for new_folder, old_folder in merge_by_name(new.folders if new else [], old.folders if old else []):
+            yield from cls.iter_compare(new_folder, old_folder, compare_hash)
+
+    @classmethod
+    def iter_changes(cls, new: FolderImage, old: FolderImage) -> Iterator[FileDiff]:
+        # changed files as soon as they are found, the same statuses as `compare` gives.
+        # An added file can be a copy of a file deleted later in the walk, so unless
+        # a deleted file with the same content was already seen, it comes at the end
+        compare_hash = new.hash_algorithm == old.hash_algorithm
+        deleted: HashFileDict = {}
+        contents: ContentDict = defaultdict(list)
+        added: List[FileDiff] = []
+        for file in cls.iter_compare(new, old, compare_hash):
+            cls._collect_file(file, deleted, contents if compare_hash else None)
+            if file.status == 'A':
+                key = content_key(file.new)
+                if key is None or all(candidate.status != 'D' for candidate in contents.get(key, [])):
+                    added.append(file)
+                    continue
+                file.set_copied(find_copy_source(file, deleted, contents))
+            if file.status != '-':
+                yield file
+        for file in added:
+            copied_from = find_copy_source(file, deleted, contents)
+            if copied_from is not None:
+                file.set_copied(copied_from)
+            yield file
+
     def print(self, line_start='', verbose=False, hide: Iterable[str] = '', hide_files: bool = False):
         print(f'{self.name}  {human_readable_size(self.copied_size)}'
               f'  {human_readable_size(self.change_in_size, plus=True)}')
@@ -215,19 +389,36 @@ class FolderDiff:
 
     def copy_modified_to(self,
                          folder: PurePath,
-                         copy_func: Callable[[os.PathLike, os.PathLike], None] = shutil.copy2):
-        if not self.has_modified():
+                         copy_func: Callable[[os.PathLike, os.PathLike], None] = copy_file,
+                         blobs: PurePath = None,
+                         stored: Set[str] = None,
+                         skip: Set[FileDiff] = frozenset(),
+                         copies: Set[FileDiff] = frozenset()):
+        # with `blobs` files with a full hash are stored there once per content,
+        # `stored` are the blobs that are already there, `skip` are saved as deltas,
+        # `copies` are stored too, the destination adds them if their source isn't the same there
+        if not self.has_modified() and not copies:
             return
+        if stored is None:
+            stored = set()
 
         if hasattr(folder, 'mkdir'):  # when saving to archive PurePath is passed
             folder.mkdir(exist_ok=True)  # otherwise Path is passed
 
         for file in self.files:
-            if file.is_modified():
+            if not file.is_modified() and file not in copies or file in skip:
+                continue
+            blob = file.blob_name() if blobs is not None else None
+            if blob is None:
                 copy_func(file.new.path, folder / file.new.name)
+            elif blob not in stored:
+                if hasattr(blobs, 'mkdir'):
+                    blobs.mkdir(exist_ok=True)
+                copy_func(file.new.path, blobs / blob)
+                stored.add(blob)
 
         for folder_diff in self.folders:
-            folder_diff.copy_modified_to(folder / folder_diff.name, copy_func)
+            folder_diff.copy_modified_to(folder / folder_diff.name, copy_func, blobs, stored, skip, copies)
 
     def iter(self) -> Iterable[FileDiff]:
         for file in self.files:
@@ -1,17 +1,26 @@
 import os
 import stat
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path, PurePath
-from time import time
+from time import time, time_ns
 
-from util import RootPath, check_signature, human_readable_size, print_tree_line
+from util import RootPath, load_header, save_header, load_body, save_body, human_readable_size, print_tree_line, LEGACY_HASH
+from util.ignore import IgnoreRules
 from util.struct_file import StructFile
-from typing import List, Optional, Dict, Union, Callable
+from typing import List, Optional, Dict, Union, Tuple
 from const import Signatures
 from image.file_image import FileImage
 
+# folders modified this close to the scan are listed again next time
+RACY_DIR_TIME = 2 * 10 ** 9
+
+DirScan = namedtuple('DirScan', ('rules', 'verify', 'racy_time'))
+
 
 class FolderImage:
     size: int
+    hash_algorithm: str = LEGACY_HASH  # only meaningful on the root folder
 
     def __init__(self, name, folders: List['FolderImage'], files: List[FileImage]):
         self.name = name
@@ -19,6 +28,7 @@ class FolderImage:
         self.files = files
         self.size = sum(file.size for file in files) + sum(folder.size for folder in folders)
         self._dict: Optional[Dict[str, Union[FileImage, 'FolderImage']]] = None
+        self.inode: Optional[Tuple[int, int, int]] = None  # (st_dev, st_ino, st_mtime_ns) of an unchanged folder
 
     def iter(self):
         yield self
@@ -33,72 +43,242 @@ class FolderImage:
         for folder in self.folders:
             yield from folder.iter_files()
 
-    def ignore(self, ignore_func: Callable[[Path], bool]):
-        self.files = list(filter(lambda f: not ignore_func(f.path), self.files))
+    def ignore(self, rules: IgnoreRules, prefix: str = ''):
+        files = [file for file in self.files if not rules.match_file(prefix + file.name)]
+        folders = [folder for folder in self.folders if not rules.match_dir(prefix + folder.name)]
+        if len(files) != len(self.files) or len(folders) != len(self.folders):
+            self.inode = None
+        self.files = files
+        self.folders = folders
         for folder in self.folders:
-            folder.ignore(ignore_func)
+            folder.ignore(rules, f'{prefix}{folder.name}/')
+
+    @classmethod
+    def image_dir(cls, path: RootPath, rules: IgnoreRules, workers: int = 1,
+                  prefix: str = '', keep_empty: bool = False,
+                  old: 'FolderImage' = None, verify: bool = True) -> 'FolderImage':
+        # prefix is the root-relative path of `path` for the ignore rules.
+        # Folders whose mtime didn't change since `old` aren't listed again, their files are
+        # taken from `old` and only stat'ed if `verify` is set: writing into an existing file
+        # doesn't change the mtime of its folder. Unverified files keep the inode of `old`
+        scan = DirScan(rules, verify, time_ns() - RACY_DIR_TIME)
+        if workers <= 1:
+            self = cls._image_tree(path, prefix, old, scan)
+        else:
+            self = cls._image_tree_parallel(path, prefix, old, scan, workers)
+        self._prune(keep_empty)
+        return self
 
     @classmethod
-    def image_dir(cls, path: RootPath, ignore_func: Callable[[Path], bool]) -> 'FolderImage':
+    def _scan_dir(cls, path: RootPath, prefix: str, old: Optional['FolderImage'], scan: 'DirScan'):
         self = cls(path.name, [], [])
-        for entry in path.iterdir():
-            entry_stat = os.stat(entry)
-            if stat.S_ISDIR(entry_stat.st_mode):
-                folder = cls.image_dir(entry, ignore_func)
-                if len(folder.files) + len(folder.folders) != 0:
-                    self.folders.append(folder)
-                    self.size += folder.size
-            elif stat.S_ISREG(entry_stat.st_mode):
-                if not ignore_func(entry):
-                    file = FileImage.from_file(entry, entry_stat)
-                    self.files.append(file)
-                    self.size += file.size
+        try:
+            dir_stat = os.stat(path, follow_symlinks=False)
+            self.inode = (dir_stat.st_dev, dir_stat.st_ino, dir_stat.st_mtime_ns)
+        except OSError:
+            self.inode = None
+        old_folders = {folder.name: folder for folder in old.folders} if old is not None else {}
+        if old is not None and self.inode is not None and old.inode == self.inode \
+                and self._reuse_files(path, prefix, old, scan):
+            self.files.sort(key=lambda f: f.name)
+            subdirs = [(path / name, f'{prefix}{name}/', folder) for name, folder in sorted(old_folders.items())
+                       if not scan.rules.match_dir(prefix + name)]
+            if len(subdirs) != len(old_folders):
+                self.inode = None  # newly ignored folders are still there
+            return self, subdirs
+
+        # DirEntry type comes from readdir, so only regular files need a stat call,
+        # and ignored folders are never listed
+        self.files = []
+        subdirs = []
+        complete = True  # every entry ends up in the image, so the folder can be reused next time
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if not scan.rules.match_dir(prefix + entry.name):
+                        subdirs.append((path / entry.name, f'{prefix}{entry.name}/', old_folders.get(entry.name)))
+                    else:
+                        complete = False
+                elif entry.is_file(follow_symlinks=False) and not scan.rules.match_file(prefix + entry.name):
+                    file_stat = entry.stat(follow_symlinks=False)
+                    self.files.append(FileImage.from_file(path / entry.name, file_stat))
+                else:
+                    complete = False
+        # images keep files and folders sorted by name
+        self.files.sort(key=lambda f: f.name)
+        subdirs.sort(key=lambda d: d[0].name)
+        # a folder changed right before the scan may change again without a new mtime
+        if not complete or self.inode is not None and self.inode[2] > scan.racy_time:
+            self.inode = None
+        return self, subdirs
+
+    def _reuse_files(self, path: RootPath, prefix: str, old: 'FolderImage', scan: 'DirScan') -> bool:
+        for old_file in old.files:
+            if scan.rules.match_file(prefix + old_file.name):
+                self.inode = None
+                continue
+            file = old_file.copy_obj()
+            file.path = path / old_file.name
+            file.partial_hash = old_file.partial_hash
+            # a loaded image has none, HashStorage.apply_file takes it from the hash storage then
+            file.inode = old_file.inode
+            if scan.verify:
+                try:
+                    file_stat = os.stat(file.path, follow_symlinks=False)
+                except OSError:
+                    return False
+                if not stat.S_ISREG(file_stat.st_mode):
+                    return False
+                new_file = FileImage.from_file(file.path, file_stat)
+                if new_file.easy_hash() == old_file.easy_hash():
+                    file.inode = new_file.inode
+                else:
+                    file = new_file
+            self.files.append(file)
+        return True
+
+    @classmethod
+    def _image_tree(cls, path: RootPath, prefix: str, old: Optional['FolderImage'], scan: 'DirScan') -> 'FolderImage':
+        self, subdirs = cls._scan_dir(path, prefix, old, scan)
+        self.folders = [cls._image_tree(subdir, sub_prefix, sub_old, scan) for subdir, sub_prefix, sub_old in subdirs]
         return self
 
-    def calc_hash(self):
+    @classmethod
+    def _image_tree_parallel(cls, path: RootPath, prefix: str, old: Optional['FolderImage'], scan: 'DirScan',
+                             workers: int) -> 'FolderImage':
+        with ThreadPoolExecutor(workers) as executor:
+            pending = {}
+
+            def submit(folder: FolderImage, subdirs: List[Tuple[RootPath, str, Optional[FolderImage]]]):
+                folder.folders = [None] * len(subdirs)
+                for i, (subdir, sub_prefix, sub_old) in enumerate(subdirs):
+                    pending[executor.submit(cls._scan_dir, subdir, sub_prefix, sub_old, scan)] = (folder, i)
+
+            self, subdirs = cls._scan_dir(path, prefix, old, scan)
+            submit(self, subdirs)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    parent, i = pending.pop(future)
+                    folder, subdirs = future.result()
+                    parent.folders[i] = folder
+                    submit(folder, subdirs)
+        return self
+
+    def _prune(self, keep_empty: bool = False):
+        # drops empty folders and computes sizes bottom-up once the whole tree is scanned
+        for folder in self.folders:
+            folder._prune(keep_empty)
+        if not keep_empty:
+            folders = [folder for folder in self.folders if len(folder.files) + len(folder.folders) != 0]
+            if len(folders) != len(self.folders):
+                self.inode = None  # the dropped folders have to be listed again next time
+            self.folders = folders
+        self.size = sum(file.size for file in self.files) + sum(folder.size for folder in self.folders)
+
+    def pruned(self) -> Optional['FolderImage']:
+        # a copy of the tree without empty folders, sharing the FileImage objects
+        folders = [folder for folder in (folder.pruned() for folder in self.folders) if folder is not None]
+        if not folders and not self.files:
+            return None
+        res = FolderImage(self.name, folders, list(self.files))
+        if len(folders) == len(self.folders):
+            res.inode = self.inode
+        return res
+
+    def calc_hash(self, algorithm: str = None):
+        if algorithm is None:
+            algorithm = self.hash_algorithm
         for file in self.files:
             t = time()
             print(file.path, end=' ')
-            file.calc_hash()
+            file.calc_hash(algorithm)
             print(file.hash, time() - t)
         for folder in self.folders:
-            folder.calc_hash()
+            folder.calc_hash(algorithm)
 
     @classmethod
     def load(cls, file: StructFile, path: RootPath) -> 'FolderImage':
-        check_signature(file, Signatures.IMAGE_SIGNATURE, 'a smolsync image file')
-        return cls._load(file, path)
+        file = file.mapped()
+        algorithm = load_header(file, Signatures.IMAGE_VERSIONS, 'a smolsync image file')
+        if file.version >= Signatures.IMAGE_COMPACT:
+            file = load_body(file)
+        if file.version >= 5:
+            # subfolders are read from the mapped file when they are first accessed
+            base = file.tell()
+            file.seek(file.size() - 8)
+            self = cls._load(file, path, base, file.read('Q')[0])
+        else:
+            self = cls._load(file, path)
+        self.hash_algorithm = algorithm
+        return self
 
     @classmethod
-    def _load(cls, file: StructFile, path: Path):
+    def _load(cls, file: StructFile, path: Path, base: int = 0, offset: int = None):
+        if offset is not None:
+            file.seek(base + offset)
         self = cls.__new__(cls)
+        file.reset_context()
         self.name = file.read_str()
         path = path / self.name
-        self.size = file.read('N')[0]
-        files_count = file.read('I')[0]
+        self.size = file.read_num('N')
+        if file.version >= 4 and file.read('?')[0]:
+            self.inode = (file.read_num('Q'), file.read_num('Q'), file.read_num('q'))
+        else:
+            self.inode = None
+        files_count = file.read_num('I')
         self.files = []
         self._dict = None
         for _ in range(files_count):
             self.files.append(FileImage.load(file, path))
-        dir_count = file.read('I')[0]
-        self.folders = []
-        for _ in range(dir_count):
-            self.folders.append(cls._load(file, path))
+        dir_count = file.read_num('I')
+        if file.version >= 5:
+            self._folders = []
+            offsets = [file.read_uint() for _ in range(dir_count)] if file.compact else file.read(f'{dir_count}Q')
+            self._lazy = (file, path, base, offsets)
+        else:
+            self.folders = [cls._load(file, path) for _ in range(dir_count)]
         return self
 
-    def save(self, file: StructFile):
-        file.write_bytes(Signatures.IMAGE_SIGNATURE)
-        self._save(file)
+    @property
+    def folders(self) -> List['FolderImage']:
+        if self._lazy is not None:
+            file, path, base, offsets = self._lazy
+            self._lazy = None
+            self._folders = [self._load(file, path, base, offset) for offset in offsets]
+        return self._folders
 
-    def _save(self, file: StructFile):
+    @folders.setter
+    def folders(self, folders: List['FolderImage']):
+        self._folders = folders
+        self._lazy = None
+
+    def save(self, file: StructFile, compression: str = 'zlib'):
+        save_header(file, Signatures.IMAGE_SIGNATURE, self.hash_algorithm)
+        save_body(file, compression)
+        base = file.tell()
+        file.write('Q', self._save(file, base))
+        file.finish()
+
+    def _save(self, file: StructFile, base: int) -> int:
+        # subfolders are written before their parent, which ends with their offsets,
+        # and the offset of the root is at the end of the file
+        offsets = [folder._save(file, base) for folder in self.folders]
+        offset = file.tell() - base
+        file.reset_context()
         file.write_str(self.name)
-        file.write('N', self.size)
-        file.write('I', len(self.files))
+        file.write_num('N', self.size)
+        file.write('?', self.inode is not None)
+        if self.inode is not None:
+            for fmt, value in zip('QQq', self.inode):
+                file.write_num(fmt, value)
+        file.write_num('I', len(self.files))
         for image_file in self.files:
             image_file.save(file)
-        file.write('I', len(self.folders))
-        for folder in self.folders:
-            folder._save(file)
+        file.write_num('I', len(offsets))
+        for child_offset in offsets:
+            file.write_num('Q', child_offset)
+        return offset
 
     def print(self, line_start='', hide_files: bool = False):
         print(f'{self.name}  {human_readable_size(self.size)}')
@@ -1,64 +1,231 @@
-from collections import namedtuple
+import struct
+from collections import namedtuple, defaultdict, Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from pathlib import Path
 from time import time
-from typing import Iterable, Dict, List
+from typing import Iterable, Dict, List, Optional
 
 from image import FileImage, FolderImage
-from util import StructFile, human_readable_size
+from image.columnar_image import ColumnarFolder
+from const import Signatures, SmolSyncException
+from util.struct_file import record
+from util import StructFile, human_readable_size, hash_files, hash_size, save_header, load_header, load_body, save_body, \
+    LEGACY_HASH, DEFAULT_HASH, HASH_NONE, HASH_PARTIAL, HASH_FULL
+from util.hashing import PARTIAL_MIN_SIZE, hashed_size
+
+
+# mod, size, st_dev, st_ino, st_mtime_ns, tier
+RECORD = record('INQQqB')
+
+HASH_BATCH_SIZE = 16 * 1024 * 1024
+HASH_BATCH_FILES = 256
+
+# the journal is merged into the storage file once it has more records than this
+JOURNAL_MIN_RECORDS = 10000
+JOURNAL_RATIO = 0.25
 
 
 class HashStorage:
     Key = namedtuple('HashID', ('path', 'modified', 'size'))
+    Inode = namedtuple('HashInode', ('dev', 'ino', 'mtime_ns', 'size'))
+    Record = namedtuple('HashRecord', ('hash', 'inode', 'tier', 'partial'))
 
-    def __init__(self):
-        self.files: Dict[HashStorage.Key, bytes] = {}
-        self.hashes: Dict[bytes, HashStorage.Key] = {}
+    def __init__(self, algorithm: str = DEFAULT_HASH):
+        self.algorithm = algorithm
+        self.files: Dict[HashStorage.Key, HashStorage.Record] = {}
+        self.hashes: Dict[bytes, HashStorage.Key] = {}  # full hashes only
+        self.paths: Dict[str, HashStorage.Key] = {}
+        self.inodes: Dict[HashStorage.Inode, HashStorage.Key] = {}  # finds renamed and moved files
+        self.pending: List[HashStorage.Key] = []  # added since loading, not in the journal yet
+        self.stored_records = 0  # records in the storage file
+        self.journal_records = 0  # records in the journal file
+        self.needs_compaction = True  # the storage file is missing or outdated
 
     @staticmethod
     def make_key(file: FileImage) -> 'HashStorage.Key':
         return HashStorage.Key(file.path.from_root().as_posix(), file.mod, file.size)
 
+    def _set(self, key: 'HashStorage.Key', record: 'HashStorage.Record'):
+        # a newer record for the same path replaces the old one
+        old_key = self.paths.get(key.path)
+        if old_key is not None and old_key != key:
+            old_record = self.files.pop(old_key, None)
+            if old_record is not None:
+                if self.hashes.get(old_record.hash) == old_key:
+                    del self.hashes[old_record.hash]
+                if self.inodes.get(old_record.inode) == old_key:
+                    del self.inodes[old_record.inode]
+        self.paths[key.path] = key
+        self.files[key] = record
+        if record.tier == HASH_FULL:
+            self.hashes[record.hash] = key
+        if record.inode is not None:
+            self.inodes[record.inode] = key
+
     def add_file(self, file: FileImage):
+        if file.hash_tier == HASH_NONE:
+            return
         key = self.make_key(file)
-        self.files[key] = file.hash
-        self.hashes[file.hash] = key
+        inode = self.Inode(*file.inode) if file.inode is not None else None
+        record = self.Record(file.hash, inode, file.hash_tier, file.partial_hash)
+        old_record = self.files.get(key)
+        if old_record is None or old_record.hash != record.hash or record.inode is not None and old_record != record:
+            self._set(key, record)
+            self.pending.append(key)
+
+    def _load_records(self, file: StructFile, count: int = None) -> int:
+        # reads until EOF if count is None, a torn record at the end of a journal is dropped
+        read = 0
+        while count is None or read < count:
+            if count is None and file.at_eof():
+                break
+            try:
+                path = file.read_name()
+                if file.compact:
+                    mod = file.read_delta('mod')
+                    size = file.read_uint()
+                    dev = file.read_delta('dev')
+                    ino = file.read_delta('ino')
+                    mtime_ns = file.read_delta('mtime_ns')
+                    tier = file.read('B')[0]
+                    inode = self.Inode(dev, ino, mtime_ns, size)
+                elif file.version >= 4:
+                    mod, size, dev, ino, mtime_ns, tier = file.read_struct(RECORD)
+                    inode = self.Inode(dev, ino, mtime_ns, size)
+                else:
+                    mod = file.read('I')[0]
+                    size = file.read('N')[0]
+                    inode = self.Inode(*file.read('QQq'), size) if file.version >= 3 else None
+                    tier = HASH_FULL
+                file_hash = file.read_hash()
+                partial = file.read_hash() if tier == HASH_FULL and file.version >= 4 and file.read('?')[0] else None
+            except (struct.error, UnicodeDecodeError):
+                self.needs_compaction = True
+                break
+            if len(file_hash) != file.hash_size or partial is not None and len(partial) != file.hash_size:
+                self.needs_compaction = True
+                break
+            if inode is not None and inode.ino == 0:
+                inode = None
+            self._set(self.Key(path, mod, size), self.Record(file_hash, inode, tier, partial))
+            read += 1
+        return read
+
+    def _save_record(self, file: StructFile, key: 'HashStorage.Key'):
+        record = self.files[key]
+        inode = record.inode[:3] if record.inode is not None else (0, 0, 0)
+        # compact storages front-code each path against the previous one
+        file.write_name(key.path)
+        if file.compact:
+            file.write_delta('mod', key.modified)
+            file.write_uint(key.size)
+            for name, value in zip(('dev', 'ino', 'mtime_ns'), inode):
+                file.write_delta(name, value)
+            file.write('B', record.tier)
+        else:
+            file.write_struct(RECORD, key.modified, key.size, *inode, record.tier)
+        file.write_hash(record.hash)
+        if record.tier == HASH_FULL:
+            file.write('?', record.partial is not None)
+            if record.partial is not None:
+                file.write_hash(record.partial)
 
     @classmethod
     def load(cls, file: StructFile) -> 'HashStorage':
-        self = cls()
-        count = file.read('I')[0]
-        for _ in range(count):
-            path = file.read_str()
-            mod = file.read('I')[0]
-            size = file.read('N')[0]
-            hash = file.file.read(20)
-            key = self.Key(path, mod, size)
-            self.files[key] = hash
-            self.hashes[hash] = key
+        # storages without a signature are always sha1
+        file = file.mapped()
+        sig = file.read_bytes(Signatures.LENGTH)
+        file.seek(0)
+        if sig in Signatures.HASH_STORAGE_VERSIONS:
+            self = cls(load_header(file, Signatures.HASH_STORAGE_VERSIONS, 'a smolsync hash storage'))
+            self.needs_compaction = sig != Signatures.HASH_STORAGE_SIGNATURE
+            if file.version >= Signatures.HASH_STORAGE_COMPACT:
+                file = load_body(file)
+        else:
+            self = cls(LEGACY_HASH)
+            file.version = 1
+            file.hash_size = 20
+        count = file.read_num('I')
+        self.stored_records = self._load_records(file, count)
         return self
 
-    def save(self, file: StructFile):
-        file.write('I', len(self.files))
-        for key, file_hash in self.files.items():
-            file.write_str(key.path)
-            file.write('I', key.modified)
-            file.write('N', key.size)
-            file.file.write(file_hash)
+    def save(self, file: StructFile, compression: str = 'zlib'):
+        save_header(file, Signatures.HASH_STORAGE_SIGNATURE, self.algorithm)
+        save_body(file, compression)
+        file.write_num('I', len(self.files))
+        for key in self.files:
+            self._save_record(file, key)
+        self.stored_records = len(self.files)
+        self.journal_records = 0
+        self.pending = []
+        self.needs_compaction = False
+        file.finish()
+
+    def replay(self, file: StructFile):
+        file = file.mapped()
+        try:
+            algorithm = load_header(file, Signatures.HASH_JOURNAL_VERSIONS, 'a smolsync hash journal')
+        except (SmolSyncException, struct.error):
+            algorithm = None
+        if algorithm != self.algorithm:
+            self.needs_compaction = True
+            return
+        self.journal_records += self._load_records(file)
+        if file.version != Signatures.HASH_JOURNAL_VERSIONS[Signatures.HASH_JOURNAL_SIGNATURE]:
+            self.needs_compaction = True
+
+    def append(self, file: StructFile, new_journal: bool):
+        if new_journal:
+            save_header(file, Signatures.HASH_JOURNAL_SIGNATURE, self.algorithm)
+        else:
+            file.hash_size = hash_size(self.algorithm)
+        for key in self.pending:
+            if key in self.files:
+                self._save_record(file, key)
+                self.journal_records += 1
+        self.pending = []
+        file.flush()
+
+    def should_compact(self) -> bool:
+        journal_records = self.journal_records + len(self.pending)
+        return self.needs_compaction \
+            or journal_records > max(JOURNAL_MIN_RECORDS, self.stored_records * JOURNAL_RATIO)
 
     @classmethod
     def from_image(cls, image: FolderImage) -> 'HashStorage':
-        self = cls()
+        self = cls(image.hash_algorithm)
         for file in image.iter_files():
             self.add_file(file)
         return self
 
+    def _find(self, file: FileImage) -> Optional['HashStorage.Record']:
+        key = self.make_key(file)
+        record = self.files.get(key)
+        if record is not None or file.inode is None:
+            return record
+        # same inode, mtime and size under another path: the file was renamed or moved
+        old_key = self.inodes.get(self.Inode(*file.inode))
+        if old_key is None:
+            return None
+        return self.files.get(old_key)
+
+    def apply_file(self, file: FileImage) -> bool:
+        record = self._find(file)
+        if record is None:
+            return False
+        file.hash = record.hash
+        file.hash_tier = record.tier
+        file.partial_hash = record.partial
+        if file.inode is None and record.inode is not None:
+            # a file reused from a loaded image without a stat, see FolderImage.image_dir
+            file.inode = tuple(record.inode)
+        self.add_file(file)
+        return True
+
     def _apply(self, image: FolderImage, output):
         for file in image.files:
-            file_hash = self.files.get(self.make_key(file))
-            if file_hash is None:
+            if not self.apply_file(file):
                 output.append(file)
-            else:
-                file.hash = file_hash
         for folder in image.folders:
             self._apply(folder, output)
 
@@ -67,17 +234,107 @@ class HashStorage:
         self._apply(image, res)
         return res
 
-    def calc_hash(self, files: Iterable[FileImage], show_progress: bool = False):
-        if show_progress:
-            files = list(files)
+    def fingerprint(self, image: FolderImage, unhashed: List[FileImage], old_image: FolderImage = None,
+                    full_hash: bool = False, show_progress: bool = False,
+                    workers: int = 1, use_processes: bool = False):
+        # The size comes first, a file with a size nothing else has is not hashed at all.
+        # Then comes a partial hash, and the full hash is computed only when the partial one
+        # collides with another file or with a file that disappeared since the old image
+        if full_hash:
+            partial = [file for file in image.iter_files() if file.hash_tier == HASH_PARTIAL]
+            self.calc_hash(unhashed + partial, show_progress, workers, use_processes)
+            return
+
+        sizes: Dict[int, List[FileImage]] = defaultdict(list)
+        for file in image.iter_files():
+            sizes[file.size].append(file)
+        gone: Dict[int, List[FileImage]] = defaultdict(list)  # deleted or modified since the old image
+        if old_image is not None:
+            old_files = old_image.iter_files_of_sizes(sizes) if isinstance(old_image, ColumnarFolder) \
+                else old_image.iter_files()
+            for file in old_files:
+                if file.size in sizes:
+                    current = image[file.path.from_root()]
+                    if not isinstance(current, FileImage) or current.size != file.size:
+                        gone[file.size].append(file)
+
+        partial, full = [], []
+        for file in unhashed:
+            if len(sizes[file.size]) + len(gone[file.size]) > 1:
+                (partial if file.size >= PARTIAL_MIN_SIZE else full).append(file)
+        self.calc_hash(partial, show_progress, workers, use_processes, partial=True)
+
+        compare_hash = old_image is None or old_image.hash_algorithm == image.hash_algorithm
+        for size, files in sizes.items():
+            others = files + gone[size] if compare_hash else files
+            if len(others) < 2:
+                continue
+            # full hashes can only be told apart from a partial one if their partial hash is known
+            unknown = 0
+            partial_count = Counter()
+            for file in others:
+                if file.hash_tier == HASH_PARTIAL:
+                    partial_count[file.hash] += 1
+                elif file.hash_tier == HASH_FULL and file.partial_hash is not None:
+                    partial_count[file.partial_hash] += 1
+                elif file.hash_tier == HASH_FULL:
+                    unknown += 1
+            for file in files:
+                if file.hash_tier == HASH_PARTIAL and (unknown > 0 or partial_count[file.hash] > 1):
+                    full.append(file)
+        self.calc_hash(full, show_progress, workers, use_processes)
+
+    def calc_hash(self, files: Iterable[FileImage], show_progress: bool = False,
+                  workers: int = 1, use_processes: bool = False, partial: bool = False):
+        # the largest files go first so that one of them doesn't end up running alone at the end,
+        # small files are sent in batches so that the pool overhead doesn't dominate
+        files = sorted(files, key=lambda f: f.size, reverse=True)
+        total_size = sum(hashed_size(file.size, partial) for file in files)
+        batches = []
+        batch, batch_size = [], 0
+        for file in files:
+            batch.append(file)
+            batch_size += hashed_size(file.size, partial)
+            if batch_size >= HASH_BATCH_SIZE or len(batch) >= HASH_BATCH_FILES:
+                batches.append(batch)
+                batch, batch_size = [], 0
+        if batch:
+            batches.append(batch)
+
         t = time()
         size = 0
-        for i, file in enumerate(files):
+        count = 0
+        tier = HASH_PARTIAL if partial else HASH_FULL
+
+        def done(batch: List[FileImage], hashes: List[bytes]):
+            nonlocal size, count
+            for file, file_hash in zip(batch, hashes):
+                if file.hash_tier == HASH_PARTIAL and not partial:
+                    file.partial_hash = file.hash
+                file.hash = file_hash
+                file.hash_tier = tier
+                self.add_file(file)
+                size += hashed_size(file.size, partial)
+            count += len(batch)
             if show_progress:
-                print(f'\r{i+1}/{len(files)} {file.path.from_root()}', end='')
-            file.calc_hash()
-            self.add_file(file)
-            size += file.size
+                dt = time() - t
+                speed = f'   {human_readable_size(size / dt)}/s' if dt > 0 else ''
+                print(f'\r{count}/{len(files)}   {human_readable_size(size)}/{human_readable_size(total_size)}'
+                      f'{speed}', end='')
+
+        if workers <= 1:
+            for batch in batches:
+                done(batch, hash_files([str(file.path) for file in batch], self.algorithm, partial))
+        else:
+            executor_cls = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+            with executor_cls(workers) as executor:
+                futures = {
+                    executor.submit(hash_files, [str(file.path) for file in batch], self.algorithm, partial): batch
+                    for batch in batches
+                }
+                for future in as_completed(futures):
+                    done(futures[future], future.result())
+
         dt = time() - t
         if show_progress and size > 0 and dt > 0:
             print(f'\r{len(files)}   {human_readable_size(size)}'
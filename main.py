@@ -1,30 +1,37 @@
 import datetime
 import json
 import os
+import shutil
+import sys
+import tempfile
 import zipfile
 from io import BytesIO
-from pathlib import PurePath
-from typing import Tuple, Optional, List
+from pathlib import PurePath, PurePosixPath, Path
+from typing import Tuple, Optional, List, Dict, Set, Callable, Iterator, BinaryIO
 
 import zipp
-from pathspec import PathSpec
 
 from args import parser, save_action, status_action, read_action, \
-    ArgsType, check_action, apply_action, compare_action
-from const import SETTINGS_NAME, SmolSyncException, Signatures
-from image import FolderImage, FolderDiff
+    ArgsType, check_action, apply_action, compare_action, watch_action, signatures_action
+from const import SETTINGS_NAME, BLOBS_NAME, DELTAS_NAME, STREAM_SUFFIXES, SmolSyncException, Signatures, \
+    DEFAULT_SCAN_WORKERS, DEFAULT_HASH_WORKERS, DEFAULT_APPLY_WORKERS, DEFAULT_DELTA_MIN_SIZE
+from image import FolderImage, FolderDiff, FileDiff
 from image.hash_storage import HashStorage
 from summary.changes_summary import ChangesSummary
 from target import Target
-from util import RootPath, StructFile
+from util import RootPath, StructFile, DEFAULT_HASH, HASH_PARTIAL, HASH_FULL, human_readable_size
+from util.archive import ParallelZipWriter, TarWriter, iter_tar
+from util.copy import copy_file, link_file
+from util.delta import BlockSignatures, make_signatures, save_signatures, load_signatures, make_delta
+from util.ignore import IgnoreRules
 
 
-def ignore_rules(rules) -> PathSpec:
+def ignore_rules(rules) -> IgnoreRules:
     if rules is None:
-        return PathSpec([])
+        return IgnoreRules()
     assert isinstance(rules, list)
     assert all(isinstance(rule, str) for rule in rules)
-    return PathSpec.from_lines('gitwildmatch', rules)
+    return IgnoreRules.from_lines(rules)
 
 
 def load_targets(args: ArgsType):
@@ -45,7 +52,17 @@ def load_targets(args: ArgsType):
                 del settings[name]
 
     targets = [
-        Target(name, path, target_settings['root'], ignore_rules(target_settings.get('ignore')))
+        Target(name, path, target_settings['root'], ignore_rules(target_settings.get('ignore')),
+               scan_workers=target_settings.get('scan_workers', DEFAULT_SCAN_WORKERS),
+               hash_workers=target_settings.get('hash_workers', DEFAULT_HASH_WORKERS),
+               hash_processes=target_settings.get('hash_processes', False),
+               hash_algorithm=target_settings.get('hash', DEFAULT_HASH),
+               full_hash=target_settings.get('full_hash', False),
+               reuse_dirs=target_settings.get('reuse_dirs', 'verify'),
+               compression=target_settings.get('compression', 'zlib'),
+               delta_min_size=target_settings.get('delta_min_size', DEFAULT_DELTA_MIN_SIZE),
+               zip_level=target_settings.get('zip_level', 6),
+               apply_workers=target_settings.get('apply_workers', DEFAULT_APPLY_WORKERS))
         for name, target_settings in settings.items()
     ]
     for target in targets:
@@ -59,6 +76,21 @@ def make_images(targets: List[Target]):
         target.make_image(use_hash_storage=True, show_progress=True)
 
 
+def print_changes(target: Target, hide: Optional[str]):
+    changes = False
+    for file in FolderDiff.iter_changes(target.image, target.old_image):
+        changes = True
+        if hide is not None and file.status in hide:
+            continue
+        path = (file.new or file.old).path.from_root().as_posix()
+        if file.status == 'C':
+            print(f'C {path} <- {file.old.path.from_root().as_posix()}')
+        else:
+            print(f'{file.status} {path}')
+    if not changes:
+        print('No changes')
+
+
 def status(args: ArgsType):
     targets = load_targets(args)
     make_images(targets)
@@ -68,6 +100,8 @@ def status(args: ArgsType):
         if target.old_image is None:
             print('No previously saved state')
             target.image.print(hide_files=args.quiet)
+        elif args.list:
+            print_changes(target, args.hide)
         else:
             diff = FolderDiff.compare(target.image, target.old_image)
             if not args.verbose and not diff.has_changes():
@@ -84,26 +118,33 @@ def status(args: ArgsType):
                 backup /= target.image_name()
                 time = datetime.datetime.now().replace(microsecond=0)
                 filename.rename(backup.with_stem(f'{target.name} {str(time).replace(":", "-")}'))
-            target.image.save(StructFile(filename.open('wb'), str(filename)))
+            target.image.save(StructFile(filename.open('wb'), str(filename)), target.compression)
 
 
 def compare(args: ArgsType):
     root, archive = read_path_for_targets(args, '.image')
 
     targets = load_targets(args)
+    if args.save:
+        for target in targets:
+            target.full_hash = True
     make_images(targets)
 
     for target in targets:
         with (root / target.image_name()).open('rb') as f:
             image = FolderImage.load(StructFile(f), target.root)
-        image.ignore(target.ignore.match_file)
+        image.ignore(target.ignore)
 
         print(f'Target {target.name}:')
         if args.save:
+            if image.hash_algorithm != target.image.hash_algorithm:
+                print(f'The image uses {image.hash_algorithm} hashes, the target uses {target.hash_algorithm}')
+                continue
             hashes = HashStorage.from_image(image)
+            new_hashes = HashStorage.from_image(target.image)
             for file in target.image.iter_files():
                 old_meta = hashes.hashes.get(file.hash)
-                new_meta = target.hash_storage.hashes.get(file.hash)
+                new_meta = new_hashes.hashes.get(file.hash)
                 if old_meta is not None and new_meta is not None:
                     old_file = image[PurePath(old_meta.path)]
                     new_file = target.image[PurePath(new_meta.path)]
@@ -127,24 +168,86 @@ def compare(args: ArgsType):
     #         target.image.save(StructFile(filename.open('wb'), str(filename)))
 
 
+def hash_copies(diff: FolderDiff, target: Target) -> Set[FileDiff]:
+    # copies found by mtime and size get a full hash, the destination checks their source against it.
+    # Those whose source had no such hash are returned to be stored, they are added if the check fails
+    copies = set()
+    for file in diff.iter():
+        if file.status != 'C':
+            continue
+        if file.new.hash_tier != HASH_FULL:
+            if file.new.hash_tier == HASH_PARTIAL:
+                file.new.partial_hash = file.new.hash
+            file.new.calc_hash(target.hash_algorithm)
+        if file.old.hash_tier != HASH_FULL or file.old.hash != file.new.hash:
+            copies.add(file)
+    return copies
+
+
+def save_deltas(diff: FolderDiff, target: Target, signatures: Dict[str, BlockSignatures],
+                store: Callable[[str, PurePath], None]) -> Set[FileDiff]:
+    # modified files the destination has block signatures of are sent as deltas
+    # when those are smaller than the file, the full hash is computed for the check on apply
+    res = set()
+    for file in diff.iter():
+        if file.status != 'M':
+            continue
+        path = file.new.path.from_root().as_posix()
+        sig = signatures.get(path)
+        if sig is None or sig.mod != file.old.mod or sig.size != file.old.size:
+            continue
+        with tempfile.NamedTemporaryFile(delete=False) as tmp:
+            file_hash, complete = make_delta(file.new.path, sig, StructFile(tmp, tmp.name),
+                                             target.hash_algorithm, file.new.size)
+        try:
+            if file.new.hash_tier == HASH_PARTIAL:
+                file.new.partial_hash = file.new.hash
+            file.new.hash = file_hash
+            file.new.hash_tier = HASH_FULL
+            size = os.path.getsize(tmp.name)
+            if complete and size < file.new.size:
+                store(tmp.name, PurePath(DELTAS_NAME, target.name, path))  # takes the file
+                res.add(file)
+                print(f'{path}  delta {human_readable_size(size)} of {human_readable_size(file.new.size)}')
+        finally:
+            if file not in res:
+                os.unlink(tmp.name)
+    return res
+
+
 def save(args: ArgsType):
     archive = None
-    if args.zip:
+    if args.zip or args.tar:
+        suffix = '.zip' if args.zip else '.tar'
         if args.path.is_dir():
-            args.path /= f'smoldiff_{datetime.date.today().strftime("%d.%m.%y")}.zip'
+            args.path /= f'smoldiff_{datetime.date.today().strftime("%d.%m.%y")}{suffix}'
         elif not args.path.exists() or args.path.is_file():
-            if args.path.suffix != '.zip':
-                raise SmolSyncException(f'File {args.path} does not end in ".zip". '
+            if args.path.suffix != suffix:
+                raise SmolSyncException(f'File {args.path} does not end in "{suffix}". '
                                         f'If you meant a directory, create it first')
         else:
             raise SmolSyncException(f"{args.path} isn't a file or a directory")
-        archive = zipfile.ZipFile(args.path, 'w', zipfile.ZIP_DEFLATED)
+        if args.zip:
+            archive = ParallelZipWriter(zipfile.ZipFile(args.path, 'w', zipfile.ZIP_DEFLATED))
+        else:
+            archive = TarWriter(args.path)
 
     targets = load_targets(args)
     make_images(targets)
+    blobs = set()  # shared by the targets
+    members = []  # files written to the archive after the diff of the target: path, name, remove
+
+    def store(src: str, dest: PurePath):
+        if archive is not None:
+            members.append((src, dest, True))
+        else:
+            (args.path / dest).parent.mkdir(parents=True, exist_ok=True)
+            shutil.move(src, args.path / dest)
 
     for target in targets:
         print(f'Target {target.name}:')
+        if args.tar:
+            blobs = set()  # a stream is applied target by target
 
         if args.base is None:
             old_image = target.old_image
@@ -158,7 +261,7 @@ def save(args: ArgsType):
                 continue
             with image_file.open('rb') as f:
                 old_image = FolderImage.load(StructFile(f), target.root)
-            old_image.ignore(target.ignore.match_file)
+            old_image.ignore(target.ignore)
 
         diff = FolderDiff.compare(target.image, old_image)
         if not args.verbose and not diff.has_changes():
@@ -169,22 +272,88 @@ def save(args: ArgsType):
             continue
 
         diff.remove_unchanged()
+        copies = hash_copies(diff, target)
 
-        if args.zip:
+        deltas = set()
+        if args.signatures is not None:
+            signatures_file = args.signatures / target.signatures_name()
+            if signatures_file.exists():
+                with signatures_file.open('rb') as f:
+                    signatures = load_signatures(StructFile(f, str(signatures_file)))
+                deltas = save_deltas(diff, target, signatures, store)
+
+        if archive is not None:
             with BytesIO() as target_info:
-                diff.save(StructFile(target_info, '*mem buffer*'))
-                archive.writestr(target.diff_name(), target_info.getvalue())
-            diff.copy_modified_to(PurePath(target.name), archive.write)
+                diff.save(StructFile(target_info, '*mem buffer*'), target.compression)
+                archive.writestr(target.diff_name(), target_info.getvalue(), target.zip_level)
+            diff.copy_modified_to(PurePath(target.name), lambda src, dest: members.append((src, dest, False)),
+                                  PurePath(BLOBS_NAME), blobs, deltas, copies)
+            if args.tar:
+                # a stream is applied in one pass, the files it has are known before they come
+                index = '\n'.join(dest.as_posix() for _, dest, _ in members)
+                archive.writestr(target.index_name(), index.encode(), 0)
+            for src, dest, remove in members:
+                archive.write(src, dest.as_posix(), target.zip_level, remove)
+            members.clear()
         else:
             args.path.mkdir(parents=True, exist_ok=True)
             diff_filename = target.diff_path(args.path)
-            diff.save(StructFile(diff_filename.open('wb'), str(diff_filename)))
-            diff.copy_modified_to(args.path / target.name)
+            diff.save(StructFile(diff_filename.open('wb'), str(diff_filename)), target.compression)
+            diff.copy_modified_to(args.path / target.name, link_file if args.hardlink else copy_file,
+                                  args.path / BLOBS_NAME, blobs, deltas, copies)
 
-    if args.zip:
+    if archive is not None:
         archive.close()
 
 
+def is_stream(path: Optional[Path]) -> bool:
+    # None is the standard input
+    return path is None or path.name.endswith(STREAM_SUFFIXES) and path.is_file()
+
+
+def split_stream(files: Iterator[Tuple[str, BinaryIO]]) \
+        -> Iterator[Tuple[str, BinaryIO, Iterator[Tuple[str, BinaryIO]]]]:
+    # the name of every target in a stream with its diff and the files that follow it,
+    # those of a target that is skipped are skipped too
+    item = next(files, None)
+    while item is not None:
+        name, diff_file = item
+        if '/' in name or not name.endswith('.diff'):
+            raise SmolSyncException(f'{name} in the stream is not a diff')
+
+        def section():
+            nonlocal item
+            while (item := next(files, None)) is not None and ('/' in item[0] or not item[0].endswith('.diff')):
+                yield item
+
+        rest = section()
+        yield name[:-len('.diff')], diff_file, rest
+        for _ in rest:
+            pass
+
+
+def read_stream_for_targets(args: ArgsType) \
+        -> Iterator[Tuple[Target, FolderDiff, Set[str], Iterator[Tuple[str, BinaryIO]]]]:
+    # a tar stream saved by `save --tar` is read in one pass: each diff is followed by the index
+    # of the files of the target and then those files
+    targets = {target.name: target for target in load_targets(args)}
+    files = iter_tar(sys.stdin.buffer if args.path is None else args.path)
+    for name, diff_file, rest in split_stream(files):
+        target = targets.get(name)
+        if target is None:
+            continue
+        diff = FolderDiff.load(StructFile(diff_file, target.diff_name()), target.root)
+        index_name, index = next(rest, (None, None))
+        if index_name != target.index_name():
+            raise SmolSyncException(f'{target.diff_name()} is not followed by {target.index_name()} in the stream')
+        members = set(index.read().decode().splitlines())
+        make_images([target])
+        target.data_root = PurePosixPath()
+        print(f'Target {target.name}:')
+        diff.connect_copied_by_path(diff)
+        yield target, diff, members, rest
+
+
 def read_path_for_targets(args: ArgsType, suffix: str = '.diff') -> Tuple[RootPath | zipp.Path, Optional[zipfile.ZipFile]]:
     root = RootPath(args.path)
     archive = None
@@ -214,6 +383,11 @@ def read_path_for_targets(args: ArgsType, suffix: str = '.diff') -> Tuple[RootPa
 
 
 def check(args: ArgsType):
+    if is_stream(args.path):
+        for target, diff, members, _ in read_stream_for_targets(args):
+            ChangesSummary(diff, target, members).print(args.verbose)
+        return
+
     root, archive = read_path_for_targets(args)
 
     targets = load_targets(args)
@@ -234,13 +408,18 @@ def check(args: ArgsType):
 
 
 def apply(args: ArgsType):
+    if is_stream(args.path):
+        for target, diff, members, files in read_stream_for_targets(args):
+            ChangesSummary(diff, target, members).run_stream(files, args.verbose)
+        return
+
     data_root, archive = read_path_for_targets(args)
 
     targets = load_targets(args)
     make_images(targets)
 
     for target in targets:
-        target.data_root = RootPath(data_root)
+        target.data_root = data_root
         with data_root.joinpath(target.diff_name()).open('rb') as f:
             diff = FolderDiff.load(StructFile(f), target.root)
         print(f'Target {target.name}:')
@@ -253,6 +432,28 @@ def apply(args: ArgsType):
         archive.close()
 
 
+def signatures(args: ArgsType):
+    targets = load_targets(args)
+    make_images(targets)
+    args.path.mkdir(parents=True, exist_ok=True)
+
+    for target in targets:
+        print(f'Target {target.name}:')
+        result = {}
+        for file in target.image.iter_files():
+            if file.size >= target.delta_min_size:
+                result[file.path.from_root().as_posix()] = make_signatures(file.path, file.mod)
+        filename = args.path / target.signatures_name()
+        with filename.open('wb') as f:
+            save_signatures(StructFile(f, str(filename)), result)
+        print(f'{len(result)} files, {human_readable_size(filename.stat().st_size)}')
+
+
+def watch(args: ArgsType):
+    from watcher import watch_targets
+    watch_targets(load_targets(args), args.interval)
+
+
 def read(args: ArgsType):
     if not args.path.exists():
         raise SmolSyncException(f'{args.path} does not exist')
@@ -275,10 +476,10 @@ def read(args: ArgsType):
         with args.path.open('rb') as f:
             sig = f.read(Signatures.LENGTH)
             f.seek(0)
-            if sig == Signatures.IMAGE_SIGNATURE:
+            if sig in Signatures.IMAGE_VERSIONS:
                 image = FolderImage.load(StructFile(f), RootPath())
                 image.print()
-            elif sig == Signatures.DIFF_SIGNATURE:
+            elif sig in Signatures.DIFF_VERSIONS:
                 diff = FolderDiff.load(StructFile(f), RootPath())
                 diff.print()
             else:
@@ -293,8 +494,12 @@ save_action.set_defaults(func=save)
 read_action.set_defaults(func=read)
 check_action.set_defaults(func=check)
 apply_action.set_defaults(func=apply)
-parsed_args = parser.parse_args()
-try:
-    parsed_args.func(parsed_args)
-except SmolSyncException as e:
-    print(e.args)
+watch_action.set_defaults(func=watch)
+signatures_action.set_defaults(func=signatures)
+
+if __name__ == '__main__':
+    parsed_args = parser.parse_args()
+    try:
+        parsed_args.func(parsed_args)
+    except SmolSyncException as e:
+        print(e.args)
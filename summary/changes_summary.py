@@ -1,51 +1,165 @@
-from typing import TYPE_CHECKING
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import TYPE_CHECKING, Iterable, Iterator, Tuple, BinaryIO, Set, Deque
 
 from const import SmolSyncException
 from image import FileDiff, FolderDiff
 from util import print_tree_line
 from summary.tasks import *
+from summary.executor import run_tasks
+from summary.file_summary import member_name
 
 
 if TYPE_CHECKING:
     from target import Target
 
+RUN_AHEAD = 16  # files started while classifying that aren't done yet, per worker
+
 
 class ChangesSummary:
-    def __init__(self, diff: FolderDiff, target: 'Target'):
-        # diff must have copies connected by `diff.connect_copied()`
+    def __init__(self, diff: FolderDiff, target: 'Target', members: Set[str] = None):
+        # diff must have copies connected by `diff.connect_copied()`,
+        # `members` are the names of the files of a stream, otherwise those in the data root
+        self.diff = diff
         self.target = target
         self.errors = []
 
         self.tasks = [
             TaskDeleted(target),
             TaskAlreadyCopied(target),
+            TaskAlreadyCopiedExisting(target),
 
             TaskAdd(target),
             TaskModify(target),
             TaskDelete(target),
             TaskCopy(target),
+            TaskCopyExisting(target),
+            TaskAddCopy(target),
             TaskGroupSourceDelete(target),
 
             TaskModifyDeleted(target),
             TaskAlreadyAdded(target),
             TaskMissing(target),
             TaskCopyGroupIsDeleted(target),
+            TaskCopySourceMissing(target),
+            TaskCopySourceChanged(target),
             TaskGroupCopy(target),
         ]
 
-        for file in diff.iter():
-            summary = FileSummary(file, target.image, target.root, target.data_dir())
-            for task in self.tasks:
+        # the decision table: the tasks that can take a file of every status, their conditions exclude each other
+        self.table = {}
+        for task in self.tasks:
+            for status in task.statuses:
+                self.table.setdefault(status, []).append(task)
+
+        self.blobs = target.blobs_dir() if diff.blobs else None
+        self.members = members if members is not None else target.data_members()
+        self.classified = False
+
+    def classify(self) -> Iterator[FileSummary]:
+        # changed files with their task set, as the diff is read
+        target = self.target
+        data_dir, deltas_dir = target.data_dir(), target.deltas_dir()
+        for file in self.diff.iter():
+            if file.status == '-':
+                continue
+            tasks = self.table.get(file.status)
+            if tasks is None:
+                continue
+            summary = FileSummary(file, target.image, target.root, data_dir, self.blobs, deltas_dir, self.members,
+                                  self.diff.hash_algorithm)
+            for task in tasks:
                 if task.condition(summary):
-                    assert summary.task is None
                     summary.task = task
-                    task.append(summary)
+                    yield summary
+                    break
+
+    def classify_all(self):
+        # every file in the list of its task
+        if self.classified:
+            return
+        for file in self.classify():
+            file.task.append(file)
+        self.classified = True
 
     def run(self, verbose=False):
+        # files of tasks that aren't ordered are run while the diff is classified, and are kept only
+        # to be printed. The ordered ones wait for the rest of the diff, see run_tasks, and so do files
+        # read from a zip archive: they are extracted in the order they are stored in it
+        workers = max(self.target.apply_workers, 1)
+        started = {}  # futures of the kept files that are done by the id of the file
+        running: Deque[Tuple[FileSummary, Future]] = deque()
+
+        def finish(file: FileSummary, future: Future):
+            note = future.result()
+            if file.task.verbosity <= verbose or note:
+                file.task.append(file)
+                started[id(file)] = future
+
+        with ThreadPoolExecutor(workers) as executor:
+            try:
+                for file in self.classify():
+                    task = file.task
+                    if task.ordered or task.reads_data and file.data_offset() is not None:
+                        task.append(file)
+                        continue
+                    if task.paths(file) is None:  # touches no files
+                        future = Future()
+                        future.set_result(task.run_file(file))
+                    else:
+                        future = executor.submit(task.run_file, file)
+                    running.append((file, future))
+                    while len(running) > workers * RUN_AHEAD or running and running[0][1].done():
+                        finish(*running.popleft())
+                while running:
+                    finish(*running.popleft())
+            except BaseException:
+                executor.shutdown(cancel_futures=True)
+                raise
+        self.classified = True
+        run_tasks(self.tasks, verbose, workers, started)
+
+    def run_stream(self, members: Iterable[Tuple[str, BinaryIO]], verbose=False):
+        # files that need data are added or patched as their files come in the stream,
+        # in the order they were saved, then the rest of the tasks are run
+        self.classify_all()
+        waiting = {}
+        left = Counter()  # files of every task that aren't run yet, tasks are lists so by id
         for task in self.tasks:
-            task.run(task.verbosity <= verbose)
+            if task.reads_data:
+                for file in task:
+                    waiting.setdefault(member_name(file.member), []).append(file)
+                left[id(task)] = len(task)
+
+        printed = None
+        for name, data in members:
+            files = waiting.pop(name, ())
+            for file in files:
+                if file is files[0]:
+                    file.source = data
+                else:  # the same blob, copied from the first file
+                    file.data_path = files[0].diff.new.path
+                task = file.task
+                do_print = task.verbosity <= verbose
+                if do_print and printed is not task:
+                    print(task.header)
+                    printed = task
+                left[id(task)] -= 1
+                task.run_one(file, do_print, left[id(task)] == 0)
+                file.source = None
+
+        # the stream ended before the data of these files
+        missing = next(task for task in self.tasks if isinstance(task, TaskMissing))
+        for files in waiting.values():
+            for file in files:
+                file.task.remove(file)
+                file.task = missing
+                missing.append(file)
+
+        run_tasks([task for task in self.tasks if not task.reads_data], verbose, self.target.apply_workers)
 
     def print(self, verbose=False):
+        self.classify_all()
         printed = False
         for task in self.tasks:
             if task.verbosity <= verbose and len(task) > 0:
@@ -0,0 +1,142 @@
+from concurrent.futures import ThreadPoolExecutor, Future
+from pathlib import Path
+from threading import Lock
+from typing import Dict, List, Optional
+
+from summary.file_summary import FileSummary
+from summary.task import Task
+from util import print_tree_line
+
+
+class Job:
+    # run_file of one file, started once the jobs it depends on are done
+    __slots__ = ('task', 'file', 'created', 'future', 'waiting', 'dependents', 'error')
+
+    def __init__(self, task: Task, file: FileSummary, created):
+        self.task = task
+        self.file = file
+        self.created = created
+        self.future = Future()
+        self.waiting = 0
+        self.dependents: List['Job'] = []
+        self.error: Optional[BaseException] = None  # of a job it depends on
+
+
+def make_jobs(tasks: List[Task], started: Dict[int, Future]) -> Dict[int, Job]:
+    # jobs by the id of their file. Files that touch the same path keep the order of the tasks:
+    # a path is read after an earlier file writes it, and written after earlier files read or write it
+    jobs = {}
+    last_write: Dict[Path, Job] = {}
+    reads: Dict[Path, List[Job]] = {}
+    for task in tasks:
+        for file in task:
+            if id(file) in started:
+                continue
+            paths = task.paths(file)
+            if paths is None:
+                continue
+            read, removed, created = paths
+            job = Job(task, file, created)
+            deps = set()
+            for path in read:
+                if path in last_write:
+                    deps.add(last_write[path])
+                reads.setdefault(path, []).append(job)
+            for paths in (removed, created):
+                for path in paths:
+                    if path in last_write:
+                        deps.add(last_write[path])
+                    deps.update(reads.pop(path, ()))
+                    last_write[path] = job
+            deps.discard(job)
+            job.waiting = len(deps)
+            for dep in deps:
+                dep.dependents.append(job)
+            jobs[id(file)] = job
+    return jobs
+
+
+def make_dirs(jobs: Dict[int, Job]):
+    # folders of the new files, before any of them are written
+    for folder in {path.parent for job in jobs.values() for path in job.created}:
+        try:
+            folder.mkdir(parents=True, exist_ok=True)
+        except OSError:
+            pass  # a file is in the way, the job fails on it in its turn
+
+
+def run_tasks(tasks: List[Task], verbose, workers: int, started: Dict[int, Future] = None):
+    # files are run on `workers` threads in the order of their dependencies,
+    # the output is printed task by task in the same order as running them one by one.
+    # `started` are the futures of files that were run already, by the id of the file
+    if started is None:
+        started = {}
+    jobs = make_jobs(tasks, started)
+    make_dirs(jobs)
+    lock = Lock()
+
+    with ThreadPoolExecutor(max(workers, 1)) as executor:
+        def start(job: Job):
+            if job.error is not None:
+                job.future.set_exception(job.error)
+                finish(job, job.error)
+                return
+            try:
+                executor.submit(run, job)
+            except RuntimeError:  # shut down after an error
+                job.future.cancel()
+
+        def run(job: Job):
+            if not job.future.set_running_or_notify_cancel():
+                return
+            try:
+                note = job.task.run_file(job.file)
+            except BaseException as e:
+                job.future.set_exception(e)
+                finish(job, e)
+            else:
+                job.future.set_result(note)
+                finish(job, None)
+
+        def finish(job: Job, error: Optional[BaseException]):
+            ready = []
+            with lock:
+                for dependent in job.dependents:
+                    if error is not None:
+                        dependent.error = error
+                    dependent.waiting -= 1
+                    if dependent.waiting == 0:
+                        ready.append(dependent)
+            for dependent in ready:
+                start(dependent)
+
+        def offset(job: Job) -> int:
+            # files of a zip archive are read in the order they are stored, it is read sequentially
+            # rather than at several places at once. Deltas come before the data of the other files
+            res = job.file.data_offset() if job.task.reads_data else None
+            return res if res is not None else -1
+
+        for job in sorted((job for job in jobs.values() if job.waiting == 0), key=offset):
+            start(job)
+
+        try:
+            for task in tasks:
+                if len(task) == 0:
+                    continue
+                do_print = task.verbosity <= verbose
+                if do_print:
+                    print(task.header)
+                last = task[-1]
+                for file in task:
+                    job = jobs.get(id(file))
+                    future = job.future if job is not None else started.get(id(file))
+                    if future is None:
+                        task.run_one(file, do_print, file is last)
+                        continue
+                    note = future.result()
+                    if do_print:
+                        task.print_file(file, print_tree_line('', file is last))
+                    task.print_note(note)
+        except BaseException:
+            executor.shutdown(cancel_futures=True)
+            raise
@@ -1,18 +1,46 @@
 from functools import cached_property
-from pathlib import Path
-from typing import TYPE_CHECKING
+from pathlib import Path, PurePath
+from typing import TYPE_CHECKING, Set, BinaryIO, Optional
 
-from image import FileDiff, FolderImage
+import zipp
+
+from image import FileDiff, FileImage, FolderImage
+from util import RootPath, hash_file, HASH_NONE, HASH_FULL
+from util.hashing import partial_hash_file
+
+
+def member_name(path) -> str:
+    # the name of a path in the data root relative to it
+    if isinstance(path, zipp.Path):
+        return path.at
+    if isinstance(path, RootPath):
+        return path.from_root().as_posix()
+    return path.as_posix()
 
 
 class FileSummary:
-    def __init__(self, file: FileDiff, image: FolderImage, root: Path, data_root: Path):
+    def __init__(self, file: FileDiff, image: FolderImage, root: Path, data_root: Path, blobs: Path = None,
+                 deltas: Path = None, members: Set[str] = None, hash_algorithm: str = None):
         self.diff = file
         self.target_image_root = image
         self.root = root
         self.data_root = data_root
+        self.blobs = blobs  # None for diffs that store every file by its path
+        self.deltas = deltas
+        # names of the files in the data root (see Target.data_members) or of the files of a stream
+        # that come after its index, paths are looked up in them. The data of a stream is then read
+        # from `source` when it comes
+        self.members = members
+        self.source: Optional[BinaryIO] = None
+        # of the hashes in the diff, they are compared with those of the image if it uses the same one
+        self.hash_algorithm = hash_algorithm
         self.task = None
 
+    def _exists(self, path: PurePath) -> bool:
+        if self.members is not None:
+            return member_name(path) in self.members
+        return path.exists()
+
     @cached_property
     def old_file_image(self):
         return self.target_image_root[self.diff.old.path.from_root()]
@@ -21,9 +49,82 @@ class FileSummary:
     def new_file_image(self):
         return self.target_image_root[self.diff.new.path.from_root()]
 
+    @cached_property
+    def data_path(self) -> Path:
+        blob = self.diff.blob_name() if self.blobs is not None else None
+        if blob is not None:
+            return self.blobs / blob
+        return self.data_root.joinpath(self.diff.new.path.from_root())
+
     @cached_property
     def exists_in_data_root(self):
-        return self.data_root.joinpath(self.diff.new.path.from_root()).exists()
+        return self._exists(self.data_path)
+
+    @cached_property
+    def delta_path(self) -> Path:
+        return self.deltas.joinpath(self.diff.new.path.from_root())
+
+    @cached_property
+    def can_patch(self):
+        # a modified file saved as a delta against the version the destination has
+        return self.deltas is not None \
+            and self.diff.status == 'M' \
+            and self.new_file_image is not None \
+            and self._exists(self.delta_path)
+
+    @property
+    def member(self) -> PurePath:
+        # the file of a stream this file is added or patched from
+        return self.data_path if self.exists_in_data_root else self.delta_path
+
+    def data_offset(self) -> Optional[int]:
+        # position of the file in a zip archive, whose files are extracted in the order they are stored.
+        # None for other sources
+        member = self.member
+        if isinstance(member, zipp.Path):
+            return member.root.getinfo(member.at).header_offset
+        return None
+
+    def data_source(self):
+        return self.source if self.source is not None else self.data_path
+
+    def delta_source(self):
+        return self.source if self.source is not None else self.delta_path
+
+    def same_file(self, image: Optional[FileImage], expected: FileImage) -> bool:
+        # whether a file of the destination is the version the diff expects. Copies are made
+        # from the destination's own files, so one that changed there would be copied instead.
+        # A hash in the diff has to match, the file is hashed if the image has none like it
+        if image is None or image.size != expected.size:
+            return False
+        if expected.hash_tier == HASH_NONE or self.hash_algorithm is None:
+            return image.mod == expected.mod
+        if image.hash_tier == expected.hash_tier and self.hash_algorithm == self.target_image_root.hash_algorithm:
+            return image.hash == expected.hash
+        if expected.hash_tier == HASH_FULL:
+            return hash_file(image.path, self.hash_algorithm) == expected.hash
+        return partial_hash_file(image.path, self.hash_algorithm) == expected.hash
+
+    @cached_property
+    def old_matches(self) -> bool:
+        # the source of a copy or a move is there and has the content of the copies, which are hashed on save
+        old = self.diff.old
+        copies = old.copied_to or ([self.diff.new] if self.diff.status == 'C' else ())
+        hashes = {copy.hash for copy in copies if copy.hash_tier == HASH_FULL}
+        if len(hashes) > 1:
+            return False  # they can't all be copies of it
+        if hashes:
+            old = old.copy_obj()
+            old.hash, old.hash_tier = hashes.pop(), HASH_FULL
+        return self.same_file(self.old_file_image, old)
+
+    @cached_property
+    def copy_source(self) -> Optional[FileImage]:
+        # a copy of a group that is already there and unchanged, to copy the rest from
+        for copy, done in zip(self.diff.old.copied_to, self.copies_done):
+            if done and self.same_file(self.target_image_root[copy.path.from_root()], copy):
+                return copy
+        return None
 
     @cached_property
     def copies_done(self):
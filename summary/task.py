@@ -1,13 +1,19 @@
+import os
 import shutil
+from contextlib import nullcontext
+from time import time
 from abc import abstractmethod, ABCMeta
 from pathlib import Path
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Optional, Tuple, Sequence
 
 import zipp
 
 from image import FileDiff, FileImage, FolderImage
 from summary.file_summary import FileSummary
-from util import print_tree_line
+from util import StructFile, print_tree_line
+from util.copy import copy_file
+from util.delta import apply_delta
+from util.hashing import MAX_BUF_SIZE
 
 if TYPE_CHECKING:
     from target import Target
@@ -16,6 +22,11 @@ if TYPE_CHECKING:
 class Task(list):
     header: str = "Unnamed task"
     verbosity = 0
+    reads_data = False  # run_file reads the data of the file from the data root
+    statuses = frozenset()  # of the files the condition takes
+    # run_file touches paths other files may touch too, so it waits for all files to be classified,
+    # the others are run while the diff is read
+    ordered = False
 
     def __init__(self, target: 'Target'):
         super().__init__()
@@ -31,24 +42,57 @@ class Task(list):
             print(self.header)
         last = self[-1]
         for file in self:
-            if do_print:
-                start = print_tree_line('', file is last)
-                self.print_file(file, start)
-            self.run_file(file)
-            print()
+            self.run_one(file, do_print, file is last)
+
+    def run_one(self, file: FileSummary, do_print: bool, last: bool):
+        if do_print:
+            start = print_tree_line('', last)
+            self.print_file(file, start)
+        self.print_note(self.run_file(file))
 
-    def run_file(self, file: FileSummary):
+    def print_note(self, note: Optional[str]):
+        if note:
+            print(note, end='')
+        print()
+
+    def run_file(self, file: FileSummary) -> Optional[str]:
+        # returns a note printed after the file
         pass
 
-    def add_file(self, dest: Path, src: Path):
+    def paths(self, file: FileSummary) -> Optional[Tuple[Sequence[Path], Sequence[Path], Sequence[Path]]]:
+        # paths in the target run_file reads, removes and creates, for the order of parallel runs.
+        # None if it touches no files, then it is run while printing
+        return None
+
+    def add_file(self, dest: Path, src: Path, mod: int = None):
+        # `mod` is the modification time of the new file, otherwise the one of `src` is kept
+        # if it is a file. Archives don't keep it exactly, and a blob has the time of only one of its files
         dest.parent.mkdir(parents=True, exist_ok=True)
-        if isinstance(src, zipp.Path):
-            with dest.open('wb') as dest:
-                with src.open('rb') as src:
-                    while chunk := src.read(4096):
-                        dest.write(chunk)
+        if isinstance(src, Path):
+            copy_file(src, dest)
+        else:  # a file in a zip archive or a stream
+            with dest.open('wb') as out:
+                with src.open('rb') if isinstance(src, zipp.Path) else nullcontext(src) as src:
+                    shutil.copyfileobj(src, out, MAX_BUF_SIZE)
+        if mod is not None:
+            os.utime(dest, (time(), mod))
+
+    def patch_file(self, dest: Path, delta, mod: int) -> bool:
+        # rebuilds the new version from the current one and a delta (a path or a file of a stream),
+        # which is checked against the hash of the new version before replacing the file
+        tmp = dest.with_name(dest.name + '.smolsync')
+        if isinstance(delta, (Path, zipp.Path)):
+            delta_file, name = delta.open('rb'), str(delta)
         else:
-            shutil.copy2(src, dest)
+            delta_file, name = nullcontext(delta), 'a delta in the stream'
+        with dest.open('rb') as base, delta_file as delta_file, tmp.open('wb') as out:
+            matches = apply_delta(base, StructFile(delta_file, name), out)
+        if not matches:
+            tmp.unlink()
+            return False
+        os.utime(tmp, (time(), mod))
+        tmp.replace(dest)
+        return True
 
     def _print_new(self, file: FileSummary, start: str):
         print(file.diff.new.path.from_root().as_posix(), end='')
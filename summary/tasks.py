@@ -1,4 +1,3 @@
-from abc import abstractmethod
 
 from summary.file_summary import FileSummary
 from summary.task import Task
@@ -6,16 +5,18 @@ from summary.task import Task
 
 class TaskMissing(Task):
     header = "Missing files"
+    statuses = {'A', 'M'}
 
     def print_file(self, file: FileSummary, start: str):
-        print(file.data_root.joinpath(file.diff.new.path.from_root()).as_posix(), end='')
+        print(file.data_path.as_posix(), end='')
 
     def condition(self, file: FileSummary) -> bool:
-        return file.diff.status in {'A', 'M'} and not file.exists_in_data_root
+        return file.diff.status in {'A', 'M'} and not file.exists_in_data_root and not file.can_patch
 
 
 class TaskDeleted(Task):
     header = "Already deleted"
+    statuses = {'D'}
     print_file = Task._print_old
     verbosity = 2
 
@@ -27,6 +28,7 @@ class TaskDeleted(Task):
 
 class TaskAlreadyAdded(Task):
     header = "Existing files to be added"
+    statuses = {'A'}
     print_file = Task._print_new
 
     def condition(self, file: FileSummary) -> bool:
@@ -36,11 +38,12 @@ class TaskAlreadyAdded(Task):
 
     def run_file(self, file: FileSummary):
         if file.new_file_image.size != file.diff.new.size:
-            print(' - file size differs, please check manually', end='')
+            return ' - file size differs, please check manually'
 
 
 class TaskCopyGroupIsDeleted(Task):
     header = 'All files are missing'
+    statuses = {'D'}
     print_file = Task._print_file_copy_list
 
     def condition(self, file: FileSummary) -> bool:
@@ -52,6 +55,7 @@ class TaskCopyGroupIsDeleted(Task):
 
 class TaskAlreadyCopied(Task):
     header = 'Already copied/moved'
+    statuses = {'D'}
     print_file = Task._print_file_copy_list
     verbosity = 2
 
@@ -64,6 +68,7 @@ class TaskAlreadyCopied(Task):
 
 class TaskDelete(Task):
     header = "Delete"
+    statuses = {'D'}
     print_file = Task._print_old
     verbosity = 1
 
@@ -75,11 +80,16 @@ class TaskDelete(Task):
     def run_file(self, file: FileSummary):
         file.diff.old.path.unlink(missing_ok=True)
 
+    def paths(self, file: FileSummary):
+        return (), (file.diff.old.path,), ()
+
 
 class TaskAdd(Task):
     header = "Add"
+    statuses = {'A'}
     print_file = Task._print_new
     verbosity = 1
+    reads_data = True
 
     def condition(self, file: FileSummary) -> bool:
         return file.diff.status == 'A' \
@@ -89,29 +99,43 @@ class TaskAdd(Task):
     def run_file(self, file: FileSummary):
         self.add_file(
             dest=file.diff.new.path,
-            src=file.data_root.joinpath(file.diff.new.path.from_root())
+            src=file.data_source(),
+            mod=file.diff.new.mod
         )
 
+    def paths(self, file: FileSummary):
+        # the data root is never written
+        return (), (), (file.diff.new.path,)
+
 
 class TaskModify(TaskAdd):
     header = "Modify"
+    statuses = {'M'}
     verbosity = 1
 
     def condition(self, file: FileSummary) -> bool:
         return file.diff.status == 'M' \
-               and file.exists_in_data_root \
+               and (file.exists_in_data_root or file.can_patch) \
                and file.new_file_image is not None
 
     def run_file(self, file: FileSummary):
         assert file.diff.new.mod > file.new_file_image.mod
-        self.add_file(
-            dest=file.diff.new.path,
-            src=file.data_root.joinpath(file.diff.new.path.from_root())
-        )
+        if file.exists_in_data_root:
+            self.add_file(
+                dest=file.diff.new.path,
+                src=file.data_source(),
+                mod=file.diff.new.mod
+            )
+        elif not self.patch_file(dest=file.diff.new.path, delta=file.delta_source(), mod=file.diff.new.mod):
+            return " - the delta doesn't match this version of the file, it wasn't changed"
+
+    def paths(self, file: FileSummary):
+        return (file.diff.new.path,), (), (file.diff.new.path,)
 
 
 class TaskModifyDeleted(TaskAdd):
     header = "Deleted files to be modified"
+    statuses = {'M'}
 
     def condition(self, file: FileSummary) -> bool:
         return file.diff.status == 'M' \
@@ -121,45 +145,144 @@ class TaskModifyDeleted(TaskAdd):
 
 class TaskCopy(Task):
     header = "Copy/move"
+    statuses = {'D'}
+    ordered = True
     print_file = Task._print_file_copy_list
     verbosity = 1
 
     def condition(self, file: FileSummary) -> bool:
         return file.diff.status == 'D' \
                and file.diff.old.copied_to is not None \
-               and any(file.copies_done) \
-               and file.old_file_image is not None
+               and not all(file.copies_done) \
+               and file.old_matches
 
     def run_file(self, file: FileSummary):
-        copy_to = file.diff.old.copied_to.copy()
+        copy_to = [copy for copy, done in zip(file.diff.old.copied_to, file.copies_done) if not done]
         first = copy_to.pop(0)
-        file.diff.old.path.rename(first)
+        first.path.parent.mkdir(parents=True, exist_ok=True)
+        file.diff.old.path.rename(first.path)
         for copy in copy_to:
             self.add_file(
                 dest=copy.path,
                 src=first.path
             )
 
+    def paths(self, file: FileSummary):
+        copy_to = [copy.path for copy, done in zip(file.diff.old.copied_to, file.copies_done) if not done]
+        return (), (file.diff.old.path,), copy_to
+
 
 class TaskGroupCopy(Task):
     header = "Copy"
+    statuses = {'D'}
+    ordered = True
     print_file = Task._print_file_copy_list
 
     def condition(self, file: FileSummary) -> bool:
         return file.diff.status == 'D' \
                and file.diff.old.copied_to is not None \
-               and any(file.copies_done) \
-               and file.old_file_image is None
+               and not all(file.copies_done) \
+               and file.old_file_image is None \
+               and file.copy_source is not None
 
-    @abstractmethod
     def run_file(self, file: FileSummary):
-        # if file.new_file_image.size != file.diff.new.size:
-        #     print(' - file size differs, please check manually', end='')
-        pass
+        # the source is gone, but one of its copies is already there
+        for copy, done in zip(file.diff.old.copied_to, file.copies_done):
+            if not done:
+                self.add_file(
+                    dest=copy.path,
+                    src=file.copy_source.path
+                )
+
+    def paths(self, file: FileSummary):
+        copy_to = [copy.path for copy, done in zip(file.diff.old.copied_to, file.copies_done) if not done]
+        return (file.copy_source.path,), (), copy_to
+
+
+class TaskCopySourceChanged(Task):
+    header = "Sources of copies are changed"
+    statuses = {'D'}
+    print_file = Task._print_file_copy_list
+
+    def condition(self, file: FileSummary) -> bool:
+        if file.diff.status != 'D' \
+                or file.diff.old.copied_to is None \
+                or all(file.copies_done):
+            return False
+        if file.old_file_image is not None:
+            return not file.old_matches
+        return any(file.copies_done) and file.copy_source is None
+
+
+class TaskCopyExisting(Task):
+    header = "Copy from unchanged files"
+    statuses = {'C'}
+    ordered = True
+    verbosity = 1
+
+    def print_file(self, file: FileSummary, start: str):
+        print(f'{file.diff.old.path.from_root().as_posix()} -> {file.diff.new.path.from_root().as_posix()}', end='')
+
+    def condition(self, file: FileSummary) -> bool:
+        # copies of deleted files are done by their source, see TaskCopy
+        return file.diff.status == 'C' \
+               and file.diff.old.copied_to is None \
+               and file.new_file_image is None \
+               and file.old_matches
+
+    def run_file(self, file: FileSummary):
+        self.add_file(
+            dest=file.diff.new.path,
+            src=file.diff.old.path
+        )
+
+    def paths(self, file: FileSummary):
+        return (file.diff.old.path,), (), (file.diff.new.path,)
+
+
+class TaskAddCopy(TaskAdd):
+    header = "Add copies whose source is missing or changed"
+    statuses = {'C'}
+
+    def condition(self, file: FileSummary) -> bool:
+        # copies whose source had no full hash are stored too, see hash_copies in main.
+        # A group is copied from the copies that are done if its source is gone
+        return file.diff.status == 'C' \
+               and file.new_file_image is None \
+               and file.exists_in_data_root \
+               and not file.old_matches \
+               and (file.diff.old.copied_to is None or file.old_file_image is not None or file.copy_source is None)
+
+
+class TaskCopySourceMissing(Task):
+    header = "Sources of copies are missing or changed"
+    statuses = {'C'}
+    print_file = TaskCopyExisting.print_file
+
+    def condition(self, file: FileSummary) -> bool:
+        return file.diff.status == 'C' \
+               and file.diff.old.copied_to is None \
+               and file.new_file_image is None \
+               and not file.exists_in_data_root \
+               and not file.old_matches
+
+
+class TaskAlreadyCopiedExisting(Task):
+    header = "Already copied from unchanged files"
+    statuses = {'C'}
+    print_file = TaskCopyExisting.print_file
+    verbosity = 2
+
+    def condition(self, file: FileSummary) -> bool:
+        return file.diff.status == 'C' \
+               and file.diff.old.copied_to is None \
+               and file.new_file_image is not None
 
 
 class TaskGroupSourceDelete(Task):
     header = "Source is missing but destinations can be copied from another"
+    statuses = {'D'}
+    ordered = True
     print_file = Task._print_file_copy_list
     verbosity = 1
 
@@ -171,3 +294,6 @@ class TaskGroupSourceDelete(Task):
 
     def run_file(self, file: FileSummary):
         file.diff.old.path.unlink(missing_ok=True)
+
+    def paths(self, file: FileSummary):
+        return (), (file.diff.old.path,), ()
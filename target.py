@@ -1,26 +1,54 @@
+import os
 from pathlib import Path, PurePath
-from typing import Union, Optional
+from time import time, sleep
+from typing import Union, Optional, Set
 
-from pathspec import PathSpec
+import zipp
 
-from image import FolderImage
+from const import DEFAULT_SCAN_WORKERS, DEFAULT_HASH_WORKERS, DEFAULT_APPLY_WORKERS, DEFAULT_DELTA_MIN_SIZE, \
+    BLOBS_NAME, DELTAS_NAME
+from image import FolderImage, ColumnarImage
 from image.hash_storage import HashStorage
-from util import RootPath, StructFile
+from util import RootPath, StructFile, DEFAULT_HASH, COMPRESSION
+from util.ignore import IgnoreRules
 
 PathT = Union[str, PurePath]
 
+LIVE_IMAGE_TIMEOUT = 30
+
 
 class Target:
-    def __init__(self, name: str, settings_path: PathT, root: PathT, ignore: PathSpec = None):
+    def __init__(self, name: str, settings_path: PathT, root: PathT, ignore: IgnoreRules = None,
+                 scan_workers: int = DEFAULT_SCAN_WORKERS, hash_workers: int = DEFAULT_HASH_WORKERS,
+                 hash_processes: bool = False, hash_algorithm: str = DEFAULT_HASH, full_hash: bool = False,
+                 reuse_dirs: str = 'verify', compression: str = 'zlib',
+                 delta_min_size: int = DEFAULT_DELTA_MIN_SIZE, zip_level: int = 6,
+                 apply_workers: int = DEFAULT_APPLY_WORKERS):
         if ignore is None:
-            ignore = PathSpec([])
+            ignore = IgnoreRules()
         self.name: str = name
         self.settings_path: RootPath = RootPath(settings_path)
         self.root: RootPath = RootPath(root)
         self.data_root: Optional[Path] = None
-        self.ignore: PathSpec = ignore
+        self.ignore: IgnoreRules = ignore
+        self.scan_workers: int = scan_workers
+        self.hash_workers: int = hash_workers
+        self.hash_processes: bool = hash_processes
+        self.hash_algorithm: str = hash_algorithm
+        self.full_hash: bool = full_hash  # hash every file in full, even if its size is unique
+        # files of folders with an unchanged mtime are taken from the most recent scan (see make_image):
+        # 'verify' checks them with a stat, 'trust' doesn't, 'off' lists every folder
+        assert reuse_dirs in ('verify', 'trust', 'off')
+        self.reuse_dirs: str = reuse_dirs
+        assert compression in COMPRESSION
+        self.compression: str = compression  # of saved images, diffs and the hash storage
+        self.delta_min_size: int = delta_min_size  # smaller files get no block signatures
+        # deflate level in zip archives, 0 stores everything. Compressed formats are always stored
+        assert 0 <= zip_level <= 9
+        self.zip_level: int = zip_level
+        self.apply_workers: int = apply_workers  # threads copying and deleting files on apply, 1 runs them in order
         self.image: Optional[FolderImage] = None
-        self.old_image: Optional[FolderImage] = None
+        self.old_image: Optional[ColumnarImage] = None
         self.hash_storage: Optional[HashStorage] = None
 
     def image_name(self) -> str:
@@ -35,18 +63,46 @@ class Target:
     def diff_path(self, path: Path) -> Path:
         return path / self.diff_name()
 
+    def index_name(self) -> str:
+        # names of the files that follow the diff in a tar stream
+        return f'{self.name}.index'
+
+    def signatures_name(self) -> str:
+        return f'{self.name}.sigs'
+
     def hash_storage_name(self) -> str:
         return f'{self.name}.hash'
 
     def hash_storage_path(self) -> Path:
         return self.settings_path / self.hash_storage_name()
 
+    def hash_journal_path(self) -> Path:
+        return self.settings_path / f'{self.name}.hashlog'
+
     def image_dir(self, dir: Path) -> Path:
         return dir / self.name
 
     def data_dir(self) -> Path:
         return self.data_root / self.name
 
+    def blobs_dir(self) -> Path:
+        return self.data_root / BLOBS_NAME
+
+    def deltas_dir(self) -> Path:
+        return self.data_root / DELTAS_NAME / self.name
+
+    def data_members(self) -> Set[str]:
+        # names of the files in the data root relative to it, from the list of a zip archive
+        # or one walk over the folders of this target, so that files aren't looked up one by one
+        if isinstance(self.data_root, zipp.Path):
+            return set(self.data_root.root.namelist())
+        res = set()
+        for folder in (self.data_dir(), self.blobs_dir(), self.deltas_dir()):
+            for dirpath, _, filenames in os.walk(folder):
+                prefix = Path(dirpath).relative_to(self.data_root).as_posix()
+                res.update(f'{prefix}/{name}' for name in filenames)
+        return res
+
     def data_diff(self) -> Path:
         return self.data_root / self.diff_name()
 
@@ -58,34 +114,106 @@ class Target:
             return None
 
         with path.open('rb') as f:
-            self.hash_storage = HashStorage.load(StructFile(f))
+            self.hash_storage = HashStorage.load(StructFile(f, str(path)))
+        journal = self.hash_journal_path()
+        if journal.exists():
+            with journal.open('rb') as f:
+                self.hash_storage.replay(StructFile(f, str(journal)))
         return self.hash_storage
 
     def save_hash_storage(self):
+        # new hashes are appended to the journal, the storage file is rewritten
+        # only when the journal grows too big
         path = self.hash_storage_path()
-        with path.open('wb') as f:
-            self.hash_storage.save(StructFile(f))
+        journal = self.hash_journal_path()
+        if self.hash_storage.should_compact():
+            self.hash_storage = HashStorage.from_image(self.image)
+            tmp_path = path.with_suffix('.hash.tmp')
+            with tmp_path.open('wb') as f:
+                self.hash_storage.save(StructFile(f, str(tmp_path)), self.compression)
+            tmp_path.replace(path)
+            journal.unlink(missing_ok=True)
+        elif self.hash_storage.pending:
+            new_journal = not journal.exists()
+            with journal.open('ab') as f:
+                self.hash_storage.append(StructFile(f, str(journal)), new_journal)
+
+    def live_image_path(self) -> Path:
+        return self.settings_path / f'{self.name}.live'
+
+    def watch_path(self) -> Path:
+        return self.settings_path / f'{self.name}.watch'
+
+    def load_live_image(self) -> Optional[FolderImage]:
+        # asks a running `smolsync watch` for a fresh snapshot through its fifo,
+        # opening the fifo fails if nothing is reading it
+        if os.name == 'nt':
+            return None
+        try:
+            fd = os.open(self.watch_path(), os.O_WRONLY | os.O_NONBLOCK)
+        except OSError:
+            return None
+        path = self.live_image_path()
+
+        def version():
+            try:
+                path_stat = path.stat()
+            except FileNotFoundError:
+                return None
+            return path_stat.st_ino, path_stat.st_mtime_ns
+
+        old_version = version()
+        try:
+            os.write(fd, b'\n')
+        finally:
+            os.close(fd)
+        deadline = time() + LIVE_IMAGE_TIMEOUT
+        while version() == old_version:
+            if time() > deadline:
+                return None
+            sleep(0.05)
 
-    def load_old_image(self) -> Optional[FolderImage]:
+        with path.open('rb') as f:
+            image = FolderImage.load(StructFile(f, str(path)), self.root)
+        image.name = ''
+        return image
+
+    def load_old_image(self) -> Optional[ColumnarImage]:
         image_file = self.image_path()
         if not image_file.exists() or not image_file.is_file():
             return None
 
         with image_file.open('rb') as image:
-            self.old_image = FolderImage.load(StructFile(image, str(image_file)), self.root)
+            self.old_image = ColumnarImage.load(StructFile(image, str(image_file)), self.root)
         return self.old_image
 
-    def make_image(self, use_hash_storage: bool = True, show_progress: bool = False) -> FolderImage:
-        self.image = FolderImage.image_dir(self.root, self.ignore.match_file)
-        self.image.name = ''
+    def make_image(self, use_hash_storage: bool = True, show_progress: bool = False,
+                   use_live_image: bool = True, keep_empty: bool = False) -> FolderImage:
+        live_image = self.load_live_image() if use_live_image else None
+        if live_image is not None and live_image.hash_algorithm == self.hash_algorithm:
+            self.image = live_image
+        else:
+            live_image = None
+            # folders are reused from the most recent scan of this target: an earlier one in this process
+            # (the watcher scans again when it loses events) or else the saved image. Only `status --save`
+            # and `save` keep a scan, so after a plain `status` the next one still compares with the saved image
+            old_image = self.image if self.image is not None else self.old_image
+            if self.reuse_dirs == 'off' or old_image is not None and old_image.hash_algorithm != self.hash_algorithm:
+                old_image = None
+            self.image = FolderImage.image_dir(self.root, self.ignore, self.scan_workers, keep_empty=keep_empty,
+                                               old=old_image, verify=self.reuse_dirs != 'trust')
+            self.image.name = ''
+            self.image.hash_algorithm = self.hash_algorithm
 
         if use_hash_storage:
             self.load_hash_storage()
-            if self.hash_storage is None:
-                self.hash_storage = HashStorage()
+            if self.hash_storage is None or self.hash_storage.algorithm != self.hash_algorithm:
+                # stored hashes of another algorithm are dropped and the files are rehashed
+                self.hash_storage = HashStorage(self.hash_algorithm)
             unhashed = self.hash_storage.apply(self.image)
-            self.hash_storage.calc_hash(unhashed, show_progress)
-            self.hash_storage = HashStorage.from_image(self.image)
-            self.save_hash_storage()
+            self.hash_storage.fingerprint(self.image, unhashed, self.old_image, self.full_hash,
+                                          show_progress, self.hash_workers, self.hash_processes)
+            if live_image is None:  # a running watcher owns the hash storage
+                self.save_hash_storage()
 
         return self.image
@@ -0,0 +1,69 @@
+import os
+import random
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
+
+from util import archive as archive_module
+from util.archive import ParallelZipWriter
+
+
+class ParallelZipWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        rng = random.Random(0)
+        self.files = {
+            'text.txt': b'some text ' * 10000,
+            'random.bin': rng.randbytes(200000),
+            'photo.jpg': b'not a jpeg ' * 1000,
+            'empty': b'',
+            'large.txt': b'large text ' * 50000,
+        }
+        for name, data in self.files.items():
+            with open(self.path(name), 'wb') as f:
+                f.write(data)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.dir.name, name)
+
+    def write(self, remove=False):
+        path = self.path('out.zip')
+        writer = ParallelZipWriter(zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED), workers=2)
+        writer.writestr('first', b'index ' * 100)
+        for name in self.files:
+            writer.write(self.path(name), f'dir/{name}', remove=remove)
+        writer.writestr('last', b'', level=0)
+        writer.close()
+        return path
+
+    def test_write(self):
+        # files above the limit are streamed into the archive, the rest are read by the workers
+        with mock.patch.object(archive_module, 'MAX_PARALLEL_SIZE', 500000):
+            path = self.write()
+        with zipfile.ZipFile(path) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(archive.namelist(), ['first'] + [f'dir/{name}' for name in self.files] + ['last'])
+            for name, data in self.files.items():
+                self.assertEqual(archive.read(f'dir/{name}'), data)
+            self.assertEqual(archive.read('first'), b'index ' * 100)
+            info = {zinfo.filename: zinfo for zinfo in archive.infolist()}
+        self.assertEqual(info['dir/text.txt'].compress_type, zipfile.ZIP_DEFLATED)
+        self.assertEqual(info['dir/large.txt'].compress_type, zipfile.ZIP_DEFLATED)
+        self.assertEqual(info['dir/random.bin'].compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(info['dir/photo.jpg'].compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(info['last'].compress_type, zipfile.ZIP_STORED)
+
+    def test_remove(self):
+        with mock.patch.object(archive_module, 'MAX_PARALLEL_SIZE', 500000):
+            path = self.write(remove=True)
+        with zipfile.ZipFile(path) as archive:
+            self.assertIsNone(archive.testzip())
+        self.assertEqual(os.listdir(self.dir.name), ['out.zip'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import os
+import tempfile
+import unittest
+
+from util.copy import copy_file, link_file
+
+
+class CopyFileTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.dir.name, 'src')
+        self.dest = os.path.join(self.dir.name, 'dest')
+        with open(self.src, 'wb') as f:
+            f.write(b'data' * 1000)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_copy(self):
+        copy_file(self.src, self.dest)
+        self.assertEqual(self.read(self.dest), b'data' * 1000)
+        self.assertEqual(os.stat(self.dest).st_mtime_ns, os.stat(self.src).st_mtime_ns)
+
+    def test_overwrite(self):
+        with open(self.dest, 'wb') as f:
+            f.write(b'old' * 5000)
+        copy_file(self.src, self.dest)
+        self.assertEqual(self.read(self.dest), b'data' * 1000)
+
+    def test_hardlinked_dest(self):
+        # saving into a folder that has hardlinks of the files from an earlier save
+        link_file(self.src, self.dest)
+        self.assertTrue(os.path.samefile(self.src, self.dest))
+        copy_file(self.src, self.dest)
+        self.assertEqual(self.read(self.src), b'data' * 1000)
+        self.assertEqual(self.read(self.dest), b'data' * 1000)
+        self.assertFalse(os.path.samefile(self.src, self.dest))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import io
+import random
+import unittest
+
+from image import FileImage, FolderImage, FolderDiff, ColumnarImage
+from util import RootPath, StructFile, HASH_FULL, HASH_NONE
+
+ROOT = RootPath('/r')
+
+
+def make_tree(rng: random.Random, contents, depth: int = 0, path=ROOT) -> FolderImage:
+    # small trees that share names and contents, so that there are copies and moves between them
+    files = {}
+    for _ in range(rng.randint(0, 6)):
+        name = f'f{rng.randint(0, 9)}'
+        mod, size, file_hash = rng.choice(contents)
+        files[name] = FileImage(name, path / name, mod, size, rng.random(), file_hash,
+                                HASH_FULL if file_hash else HASH_NONE)
+    folders = []
+    if depth < 3:
+        for i in range(rng.randint(0, 3)):
+            folder = make_tree(rng, contents, depth + 1, path / f'd{i}')
+            folder.name = f'd{i}'
+            folders.append(folder)
+    return FolderImage('', folders, sorted(files.values(), key=lambda f: f.name))
+
+
+def key(file):
+    return file.status, str((file.new or file.old).path), file.old and str(file.old.path)
+
+
+class ColumnarCompareTest(unittest.TestCase):
+    def test_same_as_objects(self):
+        # an old image loaded as columns gives the same diff as one loaded as objects
+        for seed in range(200):
+            rng = random.Random(seed)
+            contents = [(rng.randint(1, 3), rng.randint(1, 3), rng.choice([None, bytes([rng.randint(0, 3)]) * 20]))
+                        for _ in range(6)]
+            new, old = make_tree(rng, contents), make_tree(rng, contents)
+            new.hash_algorithm = old.hash_algorithm = 'sha1'
+            out = io.BytesIO()
+            old.save(StructFile(out))
+            objects = FolderImage.load(StructFile(io.BytesIO(out.getvalue())), ROOT)
+            columns = ColumnarImage.load(StructFile(io.BytesIO(out.getvalue())), ROOT)
+
+            expected = sorted(key(file) for file in FolderDiff.compare(new, objects).iter())
+            self.assertEqual(sorted(key(file) for file in FolderDiff.compare(new, columns).iter()), expected, seed)
+            self.assertEqual(sorted(key(file) for file in FolderDiff.iter_changes(new, columns)),
+                             [k for k in expected if k[0] != '-'], seed)
+
+
+class CopySourceTest(unittest.TestCase):
+    def compare(self, new_hash, old_hash):
+        # a file moved to another name with the same mtime and size
+        new = FolderImage('', [], [FileImage('b', ROOT / 'b', 100, 10, 1.0, new_hash,
+                                             HASH_FULL if new_hash else HASH_NONE)])
+        old = FolderImage('', [], [FileImage('a', ROOT / 'a', 100, 10, 1.0, old_hash,
+                                             HASH_FULL if old_hash else HASH_NONE)])
+        new.hash_algorithm = old.hash_algorithm = 'sha1'
+        return sorted(key(file) for file in FolderDiff.compare(new, old).iter())
+
+    def test_same_hash_is_moved(self):
+        self.assertEqual(self.compare(b'1' * 20, b'1' * 20), [('C', '/r/b', '/r/a'), ('D', '/r/a', '/r/a')])
+
+    def test_unknown_content_is_moved(self):
+        self.assertEqual(self.compare(None, None), [('C', '/r/b', '/r/a'), ('D', '/r/a', '/r/a')])
+
+    def test_hash_has_to_match(self):
+        # the same mtime and size aren't enough when the new file has a hash
+        self.assertEqual(self.compare(b'1' * 20, None), [('A', '/r/b', None), ('D', '/r/a', '/r/a')])
+        self.assertEqual(self.compare(b'1' * 20, b'2' * 20), [('A', '/r/b', None), ('D', '/r/a', '/r/a')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import io
+import os
+import tempfile
+import time
+import unittest
+
+from image import FolderImage, ColumnarImage
+from image.hash_storage import HashStorage
+from util import RootPath, StructFile
+from util.ignore import IgnoreRules
+
+
+class ReuseDirsTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.root = RootPath(self.dir.name)
+        os.mkdir(self.root / 'sub')
+        for i, name in enumerate(('a', 'b', 'sub/c', 'sub/d')):
+            with open(self.root / name, 'wb') as f:
+                f.write(b'x' * (i + 1) * 100)
+        # folders changed right before a scan are listed again
+        past = time.time() - 60
+        for path in (self.root / 'sub', self.root):
+            os.utime(path, (past, past))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def scan(self, old=None, verify=True) -> FolderImage:
+        image = FolderImage.image_dir(self.root, IgnoreRules(), old=old, verify=verify)
+        image.name = ''
+        return image
+
+    def load(self, image: FolderImage) -> ColumnarImage:
+        out = io.BytesIO()
+        image.save(StructFile(out))
+        return ColumnarImage.load(StructFile(io.BytesIO(out.getvalue())), self.root)
+
+    def inodes(self, image: FolderImage):
+        return {file.path.from_root().as_posix(): file.inode for file in image.iter_files()}
+
+    def test_trust_keeps_inodes(self):
+        # files that aren't stat'ed keep the inodes of the scan they are taken from
+        first = self.scan()
+        self.assertTrue(all(self.inodes(first).values()))
+        second = self.scan(old=first, verify=False)
+        self.assertEqual(self.inodes(second), self.inodes(first))
+
+    def test_trust_inodes_from_hash_storage(self):
+        # a loaded image has no inodes of files, the hash storage has them for hashed files
+        first = self.scan()
+        storage = HashStorage()
+        for file in first.iter_files():
+            file.calc_hash(storage.algorithm)
+            storage.add_file(file)
+        second = self.scan(old=self.load(first), verify=False)
+        self.assertFalse(any(self.inodes(second).values()))
+        self.assertEqual(storage.apply(second), [])
+        self.assertEqual(self.inodes(second), self.inodes(first))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import io
+import os
+import unittest
+
+from bench.image_memory import make_image
+from image import FolderImage
+from util import RootPath, StructFile, COMPRESSION, save_body, load_body
+from util.struct_file import FRAME_SIZE
+
+
+def write_records(file: StructFile, count: int):
+    for i in range(count):
+        file.write_uint(i * 1000)
+        file.write_str(f'record {i}')
+        file.write_bytes(bytes(i % 256 for _ in range(i % 50)))
+        file.write('Q', i)
+
+
+def read_records(file: StructFile, count: int):
+    for i in range(count):
+        assert file.read_uint() == i * 1000
+        assert file.read_str() == f'record {i}'
+        assert file.read_bytes(i % 50) == bytes(i % 256 for _ in range(i % 50))
+        assert file.read('Q')[0] == i
+
+
+class FramedBodyTest(unittest.TestCase):
+    count = 20_000  # several frames
+
+    def save(self, compression: str) -> bytes:
+        out = io.BytesIO()
+        file = StructFile(out)
+        file.write_bytes(b'header')
+        save_body(file, compression)
+        write_records(file, self.count)
+        file.finish()
+        return out.getvalue()
+
+    def load(self, data: bytes, stream: bool = False) -> StructFile:
+        file = StructFile(io.BytesIO(data))
+        self.assertEqual(file.read_bytes(6), b'header')
+        return load_body(file if stream else file.mapped(), stream)
+
+    def test_round_trip(self):
+        for compression in COMPRESSION:
+            data = self.save(compression)
+            file = self.load(data)
+            read_records(file, self.count)
+            self.assertTrue(file.at_eof())
+            if compression != 'none':
+                self.assertLess(len(data), file.size())
+                self.assertGreater(file.size(), FRAME_SIZE * 3)
+
+    def test_stream(self):
+        for compression in ('zlib', 'lzma'):
+            read_records(self.load(self.save(compression), stream=True), self.count)
+
+    def test_seek(self):
+        # positions are those of the uncompressed body, the same as without compression
+        plain = self.load(self.save('none'))
+        base = plain.tell()
+        positions = []
+        for i in range(self.count):
+            positions.append(plain.tell() - base)
+            plain.read_uint(), plain.read_str(), plain.read_bytes(i % 50), plain.read('Q')
+        file = self.load(self.save('zlib'))
+        for i in (self.count - 1, 7, self.count // 2, 0):
+            file.seek(positions[i])
+            self.assertEqual(file.read_uint(), i * 1000)
+            self.assertEqual(file.read_str(), f'record {i}')
+
+
+class LazyImageTest(unittest.TestCase):
+    def test_compressed_image_is_read_lazily(self):
+        image = make_image(100_000)
+        out = io.BytesIO()
+        image.save(StructFile(out), 'zlib')
+
+        loaded = FolderImage.load(StructFile(io.BytesIO(out.getvalue())), RootPath('/bench'))
+        body = loaded._lazy[0]
+        frames = []
+        decompress = body.decompress
+        body.decompress = lambda data: frames.append(1) or decompress(data)
+        # the folders of two levels are read, not the whole file
+        folder = loaded.folders[3].folders[2]
+        self.assertEqual(len(folder.files), 50)
+        self.assertGreater(len(body.frame_offsets), 40)
+        self.assertLess(len(frames), len(body.frame_offsets) // 2)
+
+        self.assertEqual(sorted(str(f.path) for f in loaded.iter_files()),
+                         sorted(str(f.path) for f in image.iter_files()))
+
+
+if __name__ == '__main__':
+    unittest.main()
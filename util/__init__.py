@@ -1,9 +1,14 @@
-import hashlib
+import lzma
+import zlib
+from typing import Dict
+
 from util.struct_file import StructFile
-from const import SmolSyncException
+from const import SmolSyncException, Signatures
 
 from .root_path import RootPath
-from .struct_file import StructFile
+from .struct_file import StructFile, FramedFile, FrameReader
+from .hashing import LEGACY_HASH, DEFAULT_HASH, HASH_NONE, HASH_PARTIAL, HASH_FULL, \
+    hash_file, hash_files, hash_stream, hash_size
 
 
 def save_signature(file: StructFile, signature):
@@ -16,17 +21,70 @@ def check_signature(file: StructFile, signature, file_type):
         raise SmolSyncException(f'{file.name} is not {file_type}')
 
 
-def hash_file(path):
-    BUF_SIZE = 65536
-    sha1 = hashlib.sha1()
-    with open(path, 'rb') as f:
-        while True:
-            data = f.read(BUF_SIZE)
-            if not data:
-                break
-            sha1.update(data)
+def save_header(file: StructFile, signature, algorithm: str):
+    file.write_bytes(signature)
+    file.write_str(algorithm)
+    file.hash_size = hash_size(algorithm)
+    file.write('B', file.hash_size)
+
+
+def load_header(file: StructFile, versions: Dict[bytes, int], file_type) -> str:
+    sig = file.read_bytes(Signatures.LENGTH)
+    file.version = versions.get(sig)
+    if file.version is None:
+        raise SmolSyncException(f'{file.name} is not {file_type}')
+    if file.version == 1:
+        file.hash_size = 20
+        return LEGACY_HASH
+    algorithm = file.read_str()
+    file.hash_size = file.read('B')[0]
+    return algorithm
+
+
+# codec of the body of compact files, the byte after the header
+COMPRESSION = {'none': 0, 'zlib': 1, 'lzma': 2}
 
-    return sha1.digest()
+
+def save_body(file: StructFile, compression: str):
+    # everything written after the header is in the compact encoding,
+    # compressed in frames that are decompressed when they are read (see FramedFile)
+    file.compact = True
+    file.write('B', COMPRESSION[compression])
+    if compression == 'zlib':
+        file.frame(lambda data: zlib.compress(data, 6))
+    elif compression == 'lzma':
+        file.frame(lzma.compress)
+
+
+def load_body(file: StructFile, stream: bool = False) -> StructFile:
+    # positions in a compressed body start at 0. Files that can't be mapped and are read
+    # once from start to end can be `stream`ed instead
+    file.compact = True
+    codec = file.read('B')[0]
+    if codec == COMPRESSION['none']:
+        return file
+    if codec == COMPRESSION['zlib']:
+        decompress = zlib.decompress
+    elif codec == COMPRESSION['lzma']:
+        decompress = lzma.decompress
+    else:
+        raise SmolSyncException(f'{file.name} is compressed with an unknown codec {codec}')
+
+    def checked(data: bytes) -> bytes:
+        try:
+            return decompress(data)
+        except (zlib.error, lzma.LZMAError) as e:
+            raise SmolSyncException(f'{file.name} is damaged: {e}')
+
+    if stream:
+        res = StructFile(FrameReader(file, checked), file.name)
+    else:
+        file = file.mapped()
+        res = FramedFile(file.buffer, file.tell(), checked, file.name)
+    res.version = file.version
+    res.hash_size = file.hash_size
+    res.compact = True
+    return res
 
 
 def human_readable_size(size, decimal_places=1, plus=False):
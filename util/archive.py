@@ -0,0 +1,166 @@
+import math
+import os
+import tarfile
+import time
+import zipfile
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from io import BytesIO
+from typing import Deque, Tuple, BinaryIO, Iterator, Union, Optional
+
+# formats that are compressed already, deflate only wastes time on them
+STORED_EXTENSIONS = {
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.avif',
+    '.mp4', '.mkv', '.mov', '.avi', '.webm', '.m4v',
+    '.mp3', '.aac', '.m4a', '.ogg', '.opus', '.flac',
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.7z', '.rar', '.lz4',
+    '.jar', '.apk', '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.epub', '.whl',
+}
+
+ENTROPY_SAMPLE_SIZE = 64 * 1024
+ENTROPY_SAMPLES = 4
+MAX_ENTROPY = 7.5  # bits per byte, above it the data is stored
+
+# larger files are compressed while being written instead of being read into memory by the workers
+MAX_PARALLEL_SIZE = 32 * 1024 * 1024
+MAX_PENDING = 4  # members read ahead of the one being written, per worker
+MAX_PENDING_SIZE = 64 * 1024 * 1024  # of the data of those members
+
+
+def entropy(data: bytes) -> float:
+    if not data:
+        return 0.0
+    n = len(data)
+    return -sum(count / n * math.log2(count / n) for count in Counter(data).values())
+
+
+def sample_entropy(f: BinaryIO, size: int) -> float:
+    # the highest entropy of a few blocks spread over the file
+    res = 0.0
+    for i in range(ENTROPY_SAMPLES):
+        f.seek(max(size - ENTROPY_SAMPLE_SIZE, 0) * i // (ENTROPY_SAMPLES - 1))
+        res = max(res, entropy(f.read(ENTROPY_SAMPLE_SIZE)))
+    f.seek(0)
+    return res
+
+
+def compression_level(name: str, f: BinaryIO, size: int, level: int) -> int:
+    # 0 if the file is better stored
+    if level == 0 or os.path.splitext(name)[1].lower() in STORED_EXTENSIONS:
+        return 0
+    if size >= ENTROPY_SAMPLE_SIZE and sample_entropy(f, size) > MAX_ENTROPY:
+        return 0
+    return level
+
+
+def read_file(path: os.PathLike, arcname: str, level: int, remove: bool) -> Tuple[zipfile.ZipInfo, bytes, int]:
+    # the member of a file with its data and the level it is compressed with
+    zinfo = zipfile.ZipInfo.from_file(path, arcname)
+    with open(path, 'rb') as f:
+        level = compression_level(arcname, f, zinfo.file_size, level)
+        data = f.read()
+    if remove:
+        os.unlink(path)
+    return zinfo, data, level
+
+
+def member_args(level: int) -> Tuple[int, Optional[int]]:
+    # compress_type and compresslevel of ZipFile.write and ZipFile.writestr
+    return (zipfile.ZIP_DEFLATED, level) if level else (zipfile.ZIP_STORED, None)
+
+
+class ParallelZipWriter:
+    # Reads the files of a zip archive and picks how they are compressed on a thread pool,
+    # and writes them in the order they were added with the public ZipFile API.
+    # It compresses a member while the next ones are read, zlib releases the GIL
+
+    def __init__(self, archive: zipfile.ZipFile, workers: int = os.cpu_count() or 1):
+        self.archive = archive
+        self.executor = ThreadPoolExecutor(workers)
+        self.pending: Deque[Tuple[Future, int]] = deque()  # with the size of the data
+        self.pending_size = 0
+        self.max_pending = workers * MAX_PENDING
+
+    def write(self, path: os.PathLike, arcname: str, level: int = 6, remove: bool = False):
+        # `remove` deletes the file once it is read
+        size = os.path.getsize(path)
+        if size > MAX_PARALLEL_SIZE:
+            self._drain()
+            self._write_large(path, arcname, level)
+            if remove:
+                os.unlink(path)
+        else:
+            self._submit(self.executor.submit(read_file, path, arcname, level, remove), size)
+
+    def writestr(self, arcname: str, data: bytes, level: int = 6):
+        zinfo = zipfile.ZipInfo(arcname, date_time=time.localtime()[:6])
+        zinfo.external_attr = 0o600 << 16
+        future = Future()
+        future.set_result((zinfo, data, level))
+        self._submit(future, len(data))
+
+    def _submit(self, future: Future, size: int):
+        self.pending.append((future, size))
+        self.pending_size += size
+        while len(self.pending) > self.max_pending or self.pending_size > MAX_PENDING_SIZE \
+                or self.pending and self.pending[0][0].done():
+            self._write_next()
+
+    def _drain(self):
+        while self.pending:
+            self._write_next()
+
+    def _write_next(self):
+        future, size = self.pending.popleft()
+        self.pending_size -= size
+        zinfo, data, level = future.result()
+        # opens the member with ZipFile.open(zinfo, 'w') and compresses the data into it
+        self.archive.writestr(zinfo, data, *member_args(level))
+
+    def _write_large(self, path: os.PathLike, arcname: str, level: int):
+        # streamed from the file
+        with open(path, 'rb') as f:
+            level = compression_level(arcname, f, os.fstat(f.fileno()).st_size, level)
+        self.archive.write(path, arcname, *member_args(level))
+
+    def close(self):
+        self._drain()
+        self.executor.shutdown()
+        self.archive.close()
+
+
+class TarWriter:
+    # A tar stream with the interface of ParallelZipWriter, members are written as they are added,
+    # so they are read back in the same order by `iter_tar`
+
+    def __init__(self, path: os.PathLike):
+        self.archive = tarfile.open(path, 'w', format=tarfile.PAX_FORMAT)
+
+    def write(self, path: os.PathLike, arcname: str, level: int = 6, remove: bool = False):
+        # the level is unused, the whole stream can be compressed instead
+        self.archive.add(path, arcname, recursive=False)
+        if remove:
+            os.unlink(path)
+
+    def writestr(self, arcname: str, data: bytes, level: int = 6):
+        tarinfo = tarfile.TarInfo(arcname)
+        tarinfo.size = len(data)
+        tarinfo.mtime = int(time.time())
+        tarinfo.mode = 0o600
+        self.archive.addfile(tarinfo, BytesIO(data))
+
+    def close(self):
+        self.archive.close()
+
+
+def iter_tar(file: Union[os.PathLike, BinaryIO]) -> Iterator[Tuple[str, BinaryIO]]:
+    # names and contents of the files in a tar stream, read in one pass without seeking,
+    # the contents can't be read once the next member is taken. Compressed streams are detected
+    if isinstance(file, (str, os.PathLike)):
+        archive = tarfile.open(file, 'r|*')
+    else:
+        archive = tarfile.open(fileobj=file, mode='r|*')
+    with archive:
+        for member in archive:
+            if member.isfile():
+                yield member.name, archive.extractfile(member)
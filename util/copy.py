@@ -0,0 +1,105 @@
+import errno
+import os
+import shutil
+import sys
+from threading import Lock
+from typing import Callable, Set, Tuple
+
+from util.hashing import MAX_BUF_SIZE
+
+if sys.platform.startswith('linux'):
+    import fcntl
+
+# Copies that stay in the kernel: a reflink shares the blocks on btrfs, xfs and the like,
+# copy_file_range lets the file system or the kernel copy them, sendfile at least skips userspace
+
+FICLONE = 0x40049409  # linux/fs.h, fcntl has it since 3.12
+COPY_CHUNK = 1024 * 1024 * 1024  # bytes asked of one copy_file_range or sendfile call
+
+# errors that mean the method isn't supported for these file systems, the next one is tried
+UNSUPPORTED = {errno.EOPNOTSUPP, errno.ENOTTY, errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EBADF, errno.EPERM}
+
+
+def _clone(src: int, dest: int, size: int):
+    fcntl.ioctl(dest, FICLONE, src)
+
+
+def _stopped_early(offset: int, size: int):
+    # some file systems (procfs, sysfs, FUSE ones) copy nothing without an error
+    raise OSError(errno.EOPNOTSUPP, f'copied {offset} of {size} bytes')
+
+
+def _copy_file_range(src: int, dest: int, size: int):
+    offset = 0
+    while offset < size:
+        copied = os.copy_file_range(src, dest, min(size - offset, COPY_CHUNK), offset, offset)
+        if copied == 0:
+            _stopped_early(offset, size)
+        offset += copied
+
+
+def _sendfile(src: int, dest: int, size: int):
+    offset = 0
+    while offset < size:
+        sent = os.sendfile(dest, src, offset, min(size - offset, COPY_CHUNK))
+        if sent == 0:
+            _stopped_early(offset, size)
+        offset += sent
+
+
+def _buffered(src: int, dest: int, size: int):
+    os.lseek(src, 0, os.SEEK_SET)
+    while block := os.read(src, MAX_BUF_SIZE):
+        view = memoryview(block)
+        while view:
+            view = view[os.write(dest, view):]
+
+
+METHODS: Tuple[Callable[[int, int, int], None], ...] = (_clone, _copy_file_range, _sendfile, _buffered)
+
+# methods that failed for a pair of devices aren't tried for them again
+_unsupported: Set[Tuple[str, int, int]] = set()
+_unsupported_lock = Lock()
+
+
+def copy_file(src: os.PathLike, dest: os.PathLike):
+    # shutil.copy2 with the data copied by the fastest method that works for the two files.
+    # A `dest` that is a hardlink of `src` is replaced, opening it for writing would empty `src`
+    try:
+        if os.path.samefile(src, dest):
+            os.unlink(dest)
+    except FileNotFoundError:
+        pass
+    if not sys.platform.startswith('linux'):
+        shutil.copy2(src, dest)
+        return
+    with open(src, 'rb') as fsrc, open(dest, 'wb') as fdest:
+        src_fd, dest_fd = fsrc.fileno(), fdest.fileno()
+        src_stat, dest_stat = os.fstat(src_fd), os.fstat(dest_fd)
+        for method in METHODS:
+            key = (method.__name__, src_stat.st_dev, dest_stat.st_dev)
+            if method is not _buffered and key in _unsupported:
+                continue
+            try:
+                method(src_fd, dest_fd, src_stat.st_size)
+                break
+            except OSError as e:
+                if method is _buffered or e.errno not in UNSUPPORTED:
+                    raise
+                with _unsupported_lock:
+                    _unsupported.add(key)
+                # whatever was written is dropped
+                os.ftruncate(dest_fd, 0)
+                os.lseek(dest_fd, 0, os.SEEK_SET)
+    shutil.copystat(src, dest)
+
+
+def link_file(src: os.PathLike, dest: os.PathLike):
+    # a hardlink shares the data with `src`, so `src` must not be changed in place while `dest`
+    # is in use. Copied when it can't be linked, on another file system for example
+    try:
+        if os.path.lexists(dest):
+            os.unlink(dest)
+        os.link(src, dest)
+    except OSError:
+        copy_file(src, dest)
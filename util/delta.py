@@ -0,0 +1,236 @@
+import hashlib
+import mmap
+import os
+import zlib
+from array import array
+from collections import namedtuple
+from math import isqrt
+from typing import Dict, List, Optional, BinaryIO, Tuple
+
+from const import Signatures, SmolSyncException
+from util import StructFile, save_header, load_header, save_body, load_body
+from util.hashing import get_hash, MAX_BUF_SIZE
+
+# rsync-like deltas: the destination sends the checksums of the blocks of its files,
+# the source sends the blocks it doesn't have and the numbers of those it does
+
+MIN_BLOCK_SIZE = 2 * 1024
+MAX_BLOCK_SIZE = 128 * 1024
+STRONG_HASH = 'blake2b-8'  # checksum of a block, the whole file is checked with its full hash
+STRONG_SIZE = 8
+
+OP_COPY = 0  # blocks of the old file: first block, count
+OP_DATA = 1  # new data: length, bytes
+OP_END = 2
+
+ADLER_MOD = 65521
+
+# a delta is abandoned for the whole file when it is mostly new data,
+# so that files that were rewritten aren't scanned to the end byte by byte
+MAX_LITERAL_FRACTION = 0.5  # of the size of the file
+MAX_UNMATCHED_BLOCKS = 128  # in a row
+
+
+def block_size(size: int) -> int:
+    return min(MAX_BLOCK_SIZE, max(MIN_BLOCK_SIZE, (isqrt(size) + 1023) // 1024 * 1024))
+
+
+def strong_hash(block) -> bytes:
+    return hashlib.blake2b(block, digest_size=STRONG_SIZE).digest()
+
+
+class BlockSignatures(namedtuple('BlockSignatures', ('mod', 'size', 'block_size', 'weak', 'strong'))):
+    # weak: adler32 of every block, strong: STRONG_SIZE bytes of every block
+
+    def index(self) -> Dict[int, List[int]]:
+        res = {}
+        for i, weak in enumerate(self.weak):
+            res.setdefault(weak, []).append(i)
+        return res
+
+    def block_length(self, i: int) -> int:
+        return min(self.block_size, self.size - i * self.block_size)
+
+
+def make_signatures(path: os.PathLike, mod: int) -> BlockSignatures:
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        bs = block_size(size)
+        weak = array('I')
+        strong = bytearray()
+        while block := f.read(bs):
+            weak.append(zlib.adler32(block))
+            strong += strong_hash(block)
+    return BlockSignatures(mod, size, bs, weak, bytes(strong))
+
+
+def save_signatures(file: StructFile, signatures: Dict[str, BlockSignatures]):
+    # the checksums don't compress
+    save_header(file, Signatures.BLOCKS_SIGNATURE, STRONG_HASH)
+    save_body(file, 'none')
+    file.write_num('I', len(signatures))
+    for path, sig in signatures.items():
+        file.write_str(path)
+        file.write_num('I', sig.mod)
+        file.write_num('N', sig.size)
+        file.write_num('I', sig.block_size)
+        file.write_num('I', len(sig.weak))
+        file.write_bytes(sig.weak.tobytes())
+        file.write_bytes(sig.strong)
+    file.finish()
+
+
+def load_signatures(file: StructFile) -> Dict[str, BlockSignatures]:
+    file = file.mapped()
+    load_header(file, Signatures.BLOCKS_VERSIONS, 'a smolsync block signatures file')
+    file = load_body(file)
+    res = {}
+    for _ in range(file.read_num('I')):
+        path = file.read_str()
+        mod = file.read_num('I')
+        size = file.read_num('N')
+        bs = file.read_num('I')
+        count = file.read_num('I')
+        weak = array('I')
+        weak.frombytes(file.read_bytes(count * weak.itemsize))
+        res[path] = BlockSignatures(mod, size, bs, weak, bytes(file.read_bytes(count * STRONG_SIZE)))
+    return res
+
+
+def make_delta(path: os.PathLike, sig: BlockSignatures, out: StructFile, algorithm: str,
+               max_size: int) -> Tuple[bytes, bool]:
+    # returns the full hash of the file and false if the delta was abandoned because
+    # it grew to max_size before compression or too much of the file is new data
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+    try:
+        return _make_delta(data, sig, out, algorithm, max_size)
+    finally:
+        if size:
+            data.close()
+
+
+def _make_delta(data, sig: BlockSignatures, out: StructFile, algorithm: str, max_size: int) -> Tuple[bytes, bool]:
+    file_hash = get_hash(algorithm)()
+    with memoryview(data) as view:
+        file_hash.update(view)
+    file_hash = file_hash.digest()
+    n = len(data)
+    bs = sig.block_size
+    index = sig.index()
+
+    save_header(out, Signatures.DELTA_SIGNATURE, algorithm)
+    save_body(out, 'zlib')
+    out.write_num('N', sig.size)
+    out.write_num('I', bs)
+
+    def match(start: int, weak: int) -> Optional[int]:
+        length = min(bs, n - start)
+        block = None
+        for i in index.get(weak, ()):
+            if sig.block_length(i) != length:
+                continue
+            if block is None:
+                block = strong_hash(data[start:start + length])
+            if sig.strong[i * STRONG_SIZE:(i + 1) * STRONG_SIZE] == block:
+                return i
+        return None
+
+    literal = 0  # start of the new data that isn't written yet
+    written = 0  # new data written
+    max_literal = n * MAX_LITERAL_FRACTION
+    max_unmatched = MAX_UNMATCHED_BLOCKS * bs
+    run = None  # blocks to copy that aren't written yet: first, count
+
+    def write_run():
+        if run is not None:
+            out.write('B', OP_COPY)
+            out.write_num('N', run[0])
+            out.write_num('N', run[1])
+
+    def write_literal(end: int):
+        nonlocal written
+        if end > literal:
+            written += end - literal
+            out.write('B', OP_DATA)
+            out.write_num('N', end - literal)
+            out.write_bytes(data[literal:end])
+
+    pos = 0
+    while pos < n:
+        unmatched = pos - literal  # since the last block that matched
+        if out.tell() + unmatched >= max_size or written + unmatched > max_literal or unmatched > max_unmatched:
+            return file_hash, False
+        end = min(pos + bs, n)
+        weak = zlib.adler32(data[pos:end])
+        i = match(pos, weak)
+        start = pos
+        if i is None and end - pos < bs:
+            pos = end
+            continue
+        if i is None:
+            # a block shifted by inserted or deleted data is found by rolling the checksum
+            # one byte at a time, at most a block ahead
+            a, b = weak & 0xffff, weak >> 16
+            last = min(pos + bs - 1, n - bs)
+            while start < last:
+                out_byte, in_byte = data[start], data[start + bs]
+                a = (a - out_byte + in_byte) % ADLER_MOD
+                b = (b - bs * out_byte + a - 1) % ADLER_MOD
+                start += 1
+                weak = b << 16 | a
+                if weak in index:
+                    i = match(start, weak)
+                    if i is not None:
+                        break
+            if i is None:
+                pos = start + 1
+                continue
+        if start > literal or run is not None and run[0] + run[1] != i:
+            write_run()
+            write_literal(start)
+            run = None
+        run = (i, 1) if run is None else (run[0], run[1] + 1)
+        pos = literal = start + sig.block_length(i)
+    write_run()
+    write_literal(n)
+    out.write('B', OP_END)
+    out.write_num('N', n)
+    out.write_hash(file_hash)
+    out.finish()
+    return file_hash, True
+
+
+def apply_delta(base: BinaryIO, delta: StructFile, out: BinaryIO) -> bool:
+    # writes the new file to `out`, false if it doesn't match the hash in the delta.
+    # The delta is decompressed as it is read
+    algorithm = load_header(delta, Signatures.DELTA_VERSIONS, 'a smolsync delta')
+    delta = load_body(delta, stream=True)
+    base_size = delta.read_num('N')
+    bs = delta.read_num('I')
+    if os.fstat(base.fileno()).st_size != base_size:
+        return False
+    file_hash = get_hash(algorithm)()
+    size = 0
+    while (op := delta.read('B')[0]) != OP_END:
+        if op == OP_COPY:
+            start = delta.read_num('N')
+            count = delta.read_num('N')
+            base.seek(start * bs)
+            left = count * bs
+            while left > 0 and (block := base.read(min(left, MAX_BUF_SIZE))):
+                out.write(block)
+                file_hash.update(block)
+                size += len(block)
+                left -= len(block)
+        elif op == OP_DATA:
+            left = delta.read_num('N')
+            while left > 0 and (block := delta.read_bytes(min(left, MAX_BUF_SIZE))):
+                out.write(block)
+                file_hash.update(block)
+                size += len(block)
+                left -= len(block)
+        else:
+            raise SmolSyncException(f'{delta.name} is damaged')
+    return delta.read_num('N') == size and delta.read_hash() == file_hash.digest()
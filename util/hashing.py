@@ -0,0 +1,126 @@
+import functools
+import hashlib
+import mmap
+import os
+import threading
+from typing import Callable, BinaryIO
+
+from const import SmolSyncException
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+LEGACY_HASH = 'sha1'  # files without an algorithm in the header
+DEFAULT_HASH = 'sha1'
+
+# what FileImage.hash represents
+HASH_NONE = 0  # nothing, the size alone tells the file apart
+HASH_PARTIAL = 1  # the size, the head, the tail and sampled blocks
+HASH_FULL = 2
+
+PARTIAL_BLOCK_SIZE = 64 * 1024
+PARTIAL_SAMPLES = 8
+# smaller files are always hashed in full
+PARTIAL_MIN_SIZE = PARTIAL_BLOCK_SIZE * (PARTIAL_SAMPLES + 2) * 4
+
+MIN_BUF_SIZE = 64 * 1024
+MAX_BUF_SIZE = 1024 * 1024
+MMAP_THRESHOLD = 256 * 1024 * 1024
+
+_buffers = threading.local()
+
+
+@functools.lru_cache(maxsize=None)
+def get_hash(name: str) -> Callable:
+    # 'sha1', 'sha256', 'blake2b', 'blake2b-20', 'blake2s-16', 'xxh3_128', 'xxh64', ...
+    algorithm, _, digest_size = name.partition('-')
+    if algorithm in ('blake2b', 'blake2s'):
+        constructor = getattr(hashlib, algorithm)
+        if digest_size:
+            constructor = functools.partial(constructor, digest_size=int(digest_size))
+        return constructor
+    if algorithm.startswith('xxh'):
+        if xxhash is None:
+            raise SmolSyncException(f'Hash algorithm {name} requires the xxhash package')
+        constructor = getattr(xxhash, algorithm, None)
+        if constructor is not None and not digest_size:
+            return constructor
+    elif algorithm in hashlib.algorithms_guaranteed and not algorithm.startswith('shake') and not digest_size:
+        return getattr(hashlib, algorithm)
+    raise SmolSyncException(f'Unknown hash algorithm: {name}')
+
+
+def hash_size(name: str) -> int:
+    return get_hash(name)().digest_size
+
+
+def buffer_size(size: int) -> int:
+    buf_size = MIN_BUF_SIZE
+    while buf_size < MAX_BUF_SIZE and buf_size * 16 < size:
+        buf_size *= 2
+    return buf_size
+
+
+def _get_buffer(size: int) -> memoryview:
+    # one buffer per thread, grown on demand and reused for every file
+    buf = getattr(_buffers, 'buf', None)
+    if buf is None or len(buf) < size:
+        buf = _buffers.buf = memoryview(bytearray(size))
+    return buf[:size]
+
+
+def hash_stream(f: BinaryIO, algorithm: str = DEFAULT_HASH, size: int = MAX_BUF_SIZE):
+    file_hash = get_hash(algorithm)()
+    buf = _get_buffer(buffer_size(size))
+    while n := f.readinto(buf):
+        file_hash.update(buf[:n])
+    return file_hash.digest()
+
+
+def hash_file(path, algorithm: str = DEFAULT_HASH, use_mmap: bool = None):
+    # use_mmap=None maps only files larger than MMAP_THRESHOLD
+    with open(path, 'rb', buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        if use_mmap is None:
+            use_mmap = size >= MMAP_THRESHOLD
+        if not use_mmap or size == 0:
+            return hash_stream(f, algorithm, size)
+        file_hash = get_hash(algorithm)()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if hasattr(mapped, 'madvise'):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            with memoryview(mapped) as view:
+                file_hash.update(view)
+        return file_hash.digest()
+
+
+def partial_hash_file(path, algorithm: str = DEFAULT_HASH):
+    file_hash = get_hash(algorithm)()
+    buf = _get_buffer(PARTIAL_BLOCK_SIZE)
+    with open(path, 'rb', buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        file_hash.update(size.to_bytes(8, 'little'))
+        step = max(size - PARTIAL_BLOCK_SIZE, 0) / (PARTIAL_SAMPLES + 1)
+        for i in range(PARTIAL_SAMPLES + 2):
+            f.seek(int(step * i))
+            read = 0
+            while read < PARTIAL_BLOCK_SIZE and (n := f.readinto(buf[read:])):
+                read += n
+            file_hash.update(buf[:read])
+    return file_hash.digest()
+
+
+def hashed_size(size: int, partial: bool = False) -> int:
+    # how many bytes are read to hash a file
+    if partial:
+        return min(size, PARTIAL_BLOCK_SIZE * (PARTIAL_SAMPLES + 2))
+    return size
+
+
+def hash_files(paths, algorithm: str = DEFAULT_HASH, partial: bool = False):
+    if partial:
+        return [partial_hash_file(path, algorithm) for path in paths]
+    return [hash_file(path, algorithm) for path in paths]
@@ -0,0 +1,47 @@
+import re
+from typing import Dict, List, Optional, Pattern, Tuple
+
+from pathspec import PathSpec
+
+
+class IgnoreRules:
+    # Paths are root-relative posix strings, folders are matched without a trailing slash.
+    # Consecutive patterns of the same polarity are merged into one regex and checked
+    # from the last block to the first, so the last matching pattern still wins.
+
+    def __init__(self, spec: Optional[PathSpec] = None):
+        self.blocks: List[Tuple[bool, Pattern]] = []
+        self._dirs: Dict[str, bool] = {}
+        if spec is None:
+            return
+        groups: List[Tuple[bool, List[str]]] = []
+        for pattern in spec.patterns:
+            if pattern.include is None:
+                continue
+            regex = re.sub(r'\(\?P<\w+>', '(?:', pattern.regex.pattern)
+            if groups and groups[-1][0] == pattern.include:
+                groups[-1][1].append(regex)
+            else:
+                groups.append((pattern.include, [regex]))
+        self.blocks = [
+            (include, re.compile('|'.join(f'(?:{regex})' for regex in regexes)))
+            for include, regexes in reversed(groups)
+        ]
+
+    @classmethod
+    def from_lines(cls, lines) -> 'IgnoreRules':
+        return cls(PathSpec.from_lines('gitwildmatch', lines))
+
+    def match_file(self, path: str) -> bool:
+        for include, regex in self.blocks:
+            if regex.match(path):
+                return include
+        return False
+
+    def match_dir(self, path: str) -> bool:
+        if not self.blocks:
+            return False
+        res = self._dirs.get(path)
+        if res is None:
+            res = self._dirs[path] = self.match_file(path + '/')
+        return res
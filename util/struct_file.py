@@ -1,36 +1,395 @@
+import io
+import mmap
+import os
 import struct
-from typing import IO
+from array import array
+from functools import lru_cache
+from typing import IO, Callable, Optional
+
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+# Compressed bodies are cut into frames of FRAME_SIZE bytes compressed on their own, each after its
+# compressed length. A length of 0 ends them, then come the offsets of the frames from the first one
+# and FRAME_TRAILER, so a frame is found from the position in the body without reading the others
+FRAME_SIZE = 64 * 1024
+FRAME_LENGTH = struct.Struct('=I')
+FRAME_TRAILER = struct.Struct('=QIQ')  # size of the body, FRAME_SIZE it was written with, number of frames
+FRAME_CACHE = 4  # frames kept decompressed, lazily read folders jump back and forth
+MAX_VARINT_SIZE = 10
+
+DOUBLE = struct.Struct('=d')
+DOUBLE_BITS = struct.Struct('=q')
+
+
+@lru_cache(maxsize=None)
+def compile_struct(fmt: str) -> struct.Struct:
+    return struct.Struct(fmt)
+
+
+@lru_cache(maxsize=None)
+def record(fmt: str) -> struct.Struct:
+    # several fields in one Struct, laid out the same as writing each of them separately
+    # with native sizes: no padding between them
+    native = {c: struct.calcsize(c) for c in 'nN'}
+    fmt = fmt.replace('N', 'Q' if native['N'] == 8 else 'I').replace('n', 'q' if native['n'] == 8 else 'i')
+    return struct.Struct('=' + fmt)
 
 
 class StructFile:
-    def __init__(self, file: IO, name: str = None):
+    # Reads from a buffer (see `mapped`) or from a file, and writes through a buffer,
+    # so `flush` has to be called after writing
+
+    def __init__(self, file: Optional[IO], name: str = None):
         self.file = file
         self.name = name
+        self.hash_size = 20
+        self.version = None  # format version from the header of the file being read
+        self.buffer = None  # bytes or mmap being read
+        self.pos = 0  # position in the buffer
+        self._out = bytearray()
+        self._written = 0
+        # compact formats: varints, names front-coded against the previous one and values stored
+        # as deltas, all of it restarting at every folder with `reset_context`
+        self.compact = False
+        self.prev_name = b''
+        self.prev_values = {}
+        self.compress_frame = None  # everything written after `frame` is compressed with it
+        self.frames = array('Q')  # offsets of the frames written
+        self._frame_pos = 0
+        self._body_start = 0
+
+    @classmethod
+    def from_buffer(cls, buffer, name: str = None, pos: int = 0) -> 'StructFile':
+        self = cls(None, name)
+        self.buffer = buffer
+        self.pos = pos
+        return self
+
+    def mapped(self) -> 'StructFile':
+        # the whole file mapped into memory at the current position, or the rest of it read
+        # into memory if it can't be mapped (a zip member)
+        if self.buffer is not None:
+            return self
+        try:
+            res = self.from_buffer(mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ),
+                                   self.name, self.file.tell())
+        except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+            res = self.from_buffer(self.file.read(), self.name)
+        res.version = self.version
+        res.hash_size = self.hash_size
+        res.compact = self.compact
+        return res
+
+    def tell(self) -> int:
+        # position in the buffer when reading, bytes written through this object when writing
+        if self.buffer is not None:
+            return self.pos
+        return self._written + len(self._out)
+
+    def seek(self, pos: int):
+        if self.buffer is not None:
+            self.pos = pos
+        else:
+            self.file.seek(pos)
+
+    def size(self) -> int:
+        return len(self.buffer)
 
     def read_all(self, count: int):
-        buff = b''
-        while len(buff) < count:
-            buff += self.file.read(count - len(buff))
-        return buff
+        parts = []
+        while count > 0:
+            part = self.file.read(count)
+            if not part:
+                break
+            parts.append(part)
+            count -= len(part)
+        return b''.join(parts)
 
     def read(self, fmt):
-        size = struct.calcsize(fmt)
-        return struct.unpack(fmt, self.file.read(size))
+        return self.read_struct(compile_struct(fmt))
+
+    def read_struct(self, s: struct.Struct):
+        if self.buffer is None:
+            return s.unpack(self.read_all(s.size))
+        res = s.unpack_from(self.buffer, self.pos)
+        self.pos += s.size
+        return res
 
     def read_bytes(self, n: int):
-        return self.file.read(n)
+        if self.buffer is None:
+            return self.read_all(n)
+        res = self.buffer[self.pos:self.pos + n]
+        self.pos += len(res)
+        return res
+
+    def at_eof(self) -> bool:
+        if self.buffer is not None:
+            return self.pos >= len(self.buffer)
+        pos = self.file.tell()
+        if self.file.read(1):
+            self.file.seek(pos)
+            return False
+        return True
+
+    def read_hash(self):
+        return self.read_bytes(self.hash_size)
 
     def read_str(self):
-        size = self.read('I')[0]
+        size = self.read_num('I')
         return self.read_bytes(size).decode()
 
     def write(self, fmt, *args):
-        self.file.write(struct.pack(fmt, *args))
+        self.write_struct(compile_struct(fmt), *args)
+
+    def write_struct(self, s: struct.Struct, *args):
+        self._out += s.pack(*args)
+        if len(self._out) >= WRITE_BUFFER_SIZE:
+            self.flush()
 
     def write_bytes(self, b: bytes):
-        self.file.write(b)
+        self._out += b
+        if len(self._out) >= WRITE_BUFFER_SIZE:
+            self.flush()
+
+    def write_hash(self, h: bytes):
+        assert len(h) == self.hash_size
+        self.write_bytes(h)
 
     def write_str(self, s):
         b = s.encode()
-        self.write('I', len(b))
+        self.write_num('I', len(b))
         self.write_bytes(b)
+
+    def reset_context(self):
+        self.prev_name = b''
+        self.prev_values = {}
+
+    def read_uint(self) -> int:
+        # LEB128: 7 bits per byte, the high bit set on all but the last byte
+        res = shift = 0
+        if self.buffer is None:
+            while True:
+                byte = self.read_bytes(1)
+                if not byte:
+                    raise struct.error('varint past the end of the file')
+                res |= (byte[0] & 0x7f) << shift
+                if byte[0] < 0x80:
+                    return res
+                shift += 7
+        buffer = self.buffer
+        pos = self.pos
+        if pos < len(buffer) and buffer[pos] < 0x80:
+            self.pos = pos + 1
+            return buffer[pos]
+        while True:
+            if pos >= len(buffer):
+                raise struct.error('varint past the end of the file')
+            byte = buffer[pos]
+            pos += 1
+            res |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                self.pos = pos
+                return res
+            shift += 7
+
+    def write_uint(self, value: int):
+        out = self._out
+        while value >= 0x80:
+            out.append(value & 0x7f | 0x80)
+            value >>= 7
+        out.append(value)
+        if len(out) >= WRITE_BUFFER_SIZE:
+            self.flush()
+
+    def read_int(self) -> int:
+        value = self.read_uint()
+        return (value >> 1) ^ -(value & 1)
+
+    def write_int(self, value: int):
+        self.write_uint(value << 1 if value >= 0 else (-value << 1) - 1)
+
+    def read_delta(self, key: str) -> int:
+        value = self.prev_values[key] = self.prev_values.get(key, 0) + self.read_int()
+        return value
+
+    def write_delta(self, key: str, value: int):
+        self.write_int(value - self.prev_values.get(key, 0))
+        self.prev_values[key] = value
+
+    def read_float_delta(self, key: str) -> float:
+        # the bits of close doubles are close too, so they are stored as a delta of the bits
+        return DOUBLE.unpack(DOUBLE_BITS.pack(self.read_delta(key)))[0]
+
+    def write_float_delta(self, key: str, value: float):
+        self.write_delta(key, DOUBLE_BITS.unpack(DOUBLE.pack(value))[0])
+
+    def read_num(self, fmt: str) -> int:
+        # one integer field: fixed size, or a varint in compact formats (zigzag for signed formats)
+        if not self.compact:
+            return self.read(fmt)[0]
+        return self.read_int() if fmt.islower() else self.read_uint()
+
+    def write_num(self, fmt: str, value: int):
+        if not self.compact:
+            self.write(fmt, value)
+        elif fmt.islower():
+            self.write_int(value)
+        else:
+            self.write_uint(value)
+
+    def read_name(self) -> str:
+        if not self.compact:
+            return self.read_str()
+        shared = self.read_uint()
+        name = self.prev_name[:shared] + self.read_bytes(self.read_uint())
+        self.prev_name = name
+        return name.decode()
+
+    def write_name(self, s: str):
+        if not self.compact:
+            self.write_str(s)
+            return
+        name = s.encode()
+        shared = len(os.path.commonprefix((name, self.prev_name)))
+        self.write_uint(shared)
+        self.write_uint(len(name) - shared)
+        self.write_bytes(name[shared:])
+        self.prev_name = name
+
+    def frame(self, compress: Callable[[bytes], bytes]):
+        # everything written after it is compressed in frames, see FramedFile. tell() keeps counting
+        # uncompressed bytes, and `finish` has to be called to write the last frame and the table
+        self.flush()
+        self.compress_frame = compress
+        self.frames = array('Q')
+        self._frame_pos = 0
+        self._body_start = self.tell()
+
+    def _write_frame(self, data):
+        compressed = self.compress_frame(data)
+        self.frames.append(self._frame_pos)
+        self.file.write(FRAME_LENGTH.pack(len(compressed)))
+        self.file.write(compressed)
+        self._frame_pos += FRAME_LENGTH.size + len(compressed)
+        self._written += len(data)
+
+    def flush(self):
+        if not self._out:
+            return
+        if self.compress_frame is None:
+            self.file.write(self._out)
+            self._written += len(self._out)
+            self._out = bytearray()
+            return
+        # only whole frames, the rest waits for more data or `finish`
+        end = len(self._out) // FRAME_SIZE * FRAME_SIZE
+        for start in range(0, end, FRAME_SIZE):
+            self._write_frame(self._out[start:start + FRAME_SIZE])
+        del self._out[:end]
+
+    def finish(self):
+        self.flush()
+        if self.compress_frame is not None:
+            if self._out:
+                self._write_frame(self._out)
+                self._out = bytearray()
+            self.file.write(FRAME_LENGTH.pack(0))
+            self.file.write(self.frames.tobytes())
+            self.file.write(FRAME_TRAILER.pack(self._written - self._body_start, FRAME_SIZE, len(self.frames)))
+            self.compress_frame = None
+
+
+class FramedFile(StructFile):
+    # Reads a compressed body from a mapped file a frame at a time, positions are in the uncompressed
+    # body, starting at 0. `buffer` is the part of the body read so far that begins at `offset`
+
+    def __init__(self, source, start: int, decompress: Callable[[bytes], bytes], name: str = None):
+        # `start` is the position of the first frame in `source`
+        super().__init__(None, name)
+        self.source = source
+        self.start = start
+        self.decompress = decompress
+        trailer = len(source) - FRAME_TRAILER.size
+        self.total, self.frame_size, count = FRAME_TRAILER.unpack_from(source, trailer)
+        self.frame_offsets = array('Q')
+        self.frame_offsets.frombytes(source[trailer - count * self.frame_offsets.itemsize:trailer])
+        self.buffer = b''
+        self.offset = 0
+        self.next_frame = 0
+        self._cache = {}
+
+    def _frame(self, i: int) -> bytes:
+        data = self._cache.get(i)
+        if data is None:
+            pos = self.start + self.frame_offsets[i]
+            length = FRAME_LENGTH.unpack_from(self.source, pos)[0]
+            pos += FRAME_LENGTH.size
+            data = self.decompress(self.source[pos:pos + length])
+            if len(self._cache) >= FRAME_CACHE:
+                del self._cache[next(iter(self._cache))]
+            self._cache[i] = data
+        return data
+
+    def _ensure(self, n: int):
+        # at least n bytes in the buffer after pos, unless the body ends before
+        if len(self.buffer) - self.pos >= n:
+            return
+        parts = [self.buffer[self.pos:]]
+        have = len(parts[0])
+        self.offset += self.pos
+        self.pos = 0
+        while have < n and self.next_frame < len(self.frame_offsets):
+            parts.append(self._frame(self.next_frame))
+            have += len(parts[-1])
+            self.next_frame += 1
+        self.buffer = b''.join(parts)
+
+    def tell(self) -> int:
+        return self.offset + self.pos
+
+    def seek(self, pos: int):
+        i = pos // self.frame_size
+        self.buffer = self._frame(i) if i < len(self.frame_offsets) else b''
+        self.offset = i * self.frame_size
+        self.pos = pos - self.offset
+        self.next_frame = i + 1
+
+    def size(self) -> int:
+        return self.total
+
+    def at_eof(self) -> bool:
+        return self.tell() >= self.total
+
+    def read_struct(self, s: struct.Struct):
+        self._ensure(s.size)
+        return super().read_struct(s)
+
+    def read_bytes(self, n: int):
+        self._ensure(n)
+        return super().read_bytes(n)
+
+    def read_uint(self) -> int:
+        self._ensure(MAX_VARINT_SIZE)
+        return super().read_uint()
+
+
+class FrameReader:
+    # A compressed body decompressed a frame at a time as it is read from start to end,
+    # for files that can't be mapped, a StructFile reads from it like from a file
+
+    def __init__(self, file: StructFile, decompress: Callable[[bytes], bytes]):
+        self.file = file
+        self.decompress = decompress
+        self.data = bytearray()  # decompressed and not read yet
+        self.ended = False
+
+    def read(self, n: int) -> bytes:
+        while len(self.data) < n and not self.ended:
+            length = self.file.read_struct(FRAME_LENGTH)[0]
+            if length == 0:
+                self.ended = True
+            else:
+                self.data += self.decompress(self.file.read_bytes(length))
+        res = bytes(self.data[:n])
+        del self.data[:n]
+        return res
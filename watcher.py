@@ -0,0 +1,241 @@
+import os
+import queue
+import select
+import signal
+import stat
+import sys
+import threading
+from bisect import bisect_left, insort
+from operator import attrgetter
+from time import time
+from typing import Dict, List, Optional, Tuple, Union
+
+from image import FileImage, FolderImage
+from target import Target
+from util import RootPath, StructFile, hash_file, HASH_FULL
+from util.inotify import Inotify, IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, \
+    IN_DELETE, IN_Q_OVERFLOW, IN_IGNORED, IN_ONLYDIR, IN_DONT_FOLLOW, IN_EXCL_UNLINK
+
+# files are picked up when they are closed after writing, not on every write
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE \
+             | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK
+
+
+def _inode(file_stat: os.stat_result):
+    return file_stat.st_dev, file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size
+
+
+class Watcher:
+    # Keeps target.image and target.hash_storage current from inotify events,
+    # and writes the image to target.live_image_path() for other commands
+
+    def __init__(self, target: Target, interval: float):
+        self.target = target
+        self.interval = interval
+        self.inotify = Inotify()
+        self.watches: Dict[int, Tuple[FolderImage, RootPath, str]] = {}
+        self.folder_watches: Dict[int, int] = {}  # id(folder) -> watch descriptor
+        self.lock = threading.Lock()
+        self.hash_queue: 'queue.Queue[Optional[FileImage]]' = queue.Queue()
+        self.hasher = threading.Thread(target=self._hash_loop, daemon=True)
+        self.fifo: Optional[int] = None
+        self.changed = False
+        self.last_snapshot = 0.0
+
+    def start(self):
+        target = self.target
+        target.load_old_image()
+        target.make_image(show_progress=True, use_live_image=False, keep_empty=True)
+        self._watch_tree(target.image, target.root, '')
+
+        fifo_path = target.watch_path()
+        fifo_path.unlink(missing_ok=True)
+        os.mkfifo(fifo_path)
+        # opened for writing as well, so that select doesn't see EOF after every client
+        self.fifo = os.open(fifo_path, os.O_RDWR | os.O_NONBLOCK)
+        self.hasher.start()
+        self.snapshot()
+
+    def close(self):
+        self.hash_queue.put(None)
+        self.snapshot()
+        if self.fifo is not None:
+            os.close(self.fifo)
+            self.target.watch_path().unlink(missing_ok=True)
+        self.inotify.close()
+
+    def _watch_tree(self, folder: FolderImage, path: RootPath, prefix: str):
+        try:
+            wd = self.inotify.add_watch(path, WATCH_MASK)
+        except OSError:
+            return
+        self.watches[wd] = (folder, path, prefix)
+        self.folder_watches[id(folder)] = wd
+        for sub_folder in folder.folders:
+            self._watch_tree(sub_folder, path / sub_folder.name, f'{prefix}{sub_folder.name}/')
+
+    def _unwatch_tree(self, folder: FolderImage):
+        wd = self.folder_watches.pop(id(folder), None)
+        if wd is not None:
+            self.watches.pop(wd, None)
+            self.inotify.rm_watch(wd)
+        for sub_folder in folder.folders:
+            self._unwatch_tree(sub_folder)
+
+    def _rescan(self):
+        for wd in self.watches:
+            self.inotify.rm_watch(wd)
+        self.watches.clear()
+        self.folder_watches.clear()
+        self.target.make_image(use_live_image=False, keep_empty=True)
+        self._watch_tree(self.target.image, self.target.root, '')
+        self.changed = True
+
+    def handle_events(self):
+        events = self.inotify.read()
+        dirty: Dict[Tuple[int, str], None] = {}
+        with self.lock:
+            for event in events:
+                if event.mask & IN_Q_OVERFLOW:
+                    self._rescan()
+                    return
+                if event.mask & IN_IGNORED:
+                    folder = self.watches.pop(event.wd, (None,))[0]
+                    if folder is not None:
+                        self.folder_watches.pop(id(folder), None)
+                elif event.name:
+                    dirty[(event.wd, event.name)] = None
+            for wd, name in dirty:
+                if wd in self.watches:
+                    self._update(wd, name)
+
+    def handle_requests(self):
+        try:
+            os.read(self.fifo, 4096)
+        except BlockingIOError:
+            return
+        self.handle_events()
+        self.snapshot()
+
+    def _update(self, wd: int, name: str):
+        folder, path, prefix = self.watches[wd]
+        entry_path = path / name
+        rel_path = prefix + name
+        rules = self.target.ignore
+        try:
+            entry_stat = os.lstat(entry_path)
+        except OSError:
+            entry_stat = None
+        old = _get_child(folder, name)
+
+        if entry_stat is not None and stat.S_ISREG(entry_stat.st_mode) and not rules.match_file(rel_path):
+            if isinstance(old, FileImage) and old.inode == _inode(entry_stat):
+                return
+            self._remove_child(folder, old)
+            file = FileImage.from_file(entry_path, entry_stat)
+            insort(folder.files, file, key=_name)
+            self._hash_later(file)
+        elif entry_stat is not None and stat.S_ISDIR(entry_stat.st_mode) and not rules.match_dir(rel_path):
+            if isinstance(old, FolderImage):
+                return
+            self._remove_child(folder, old)
+            sub_folder = FolderImage.image_dir(entry_path, rules, prefix=rel_path + '/', keep_empty=True)
+            insort(folder.folders, sub_folder, key=_name)
+            self._watch_tree(sub_folder, entry_path, rel_path + '/')
+            for file in sub_folder.iter_files():
+                self._hash_later(file)
+        elif old is not None:
+            self._remove_child(folder, old)
+        else:
+            return
+        folder._dict = None
+        folder.inode = None
+        self.changed = True
+
+    def _remove_child(self, folder: FolderImage, child: Union[FileImage, FolderImage, None]):
+        if isinstance(child, FileImage):
+            del folder.files[_index(folder.files, child.name)]
+        elif isinstance(child, FolderImage):
+            del folder.folders[_index(folder.folders, child.name)]
+            self._unwatch_tree(child)
+
+    def _hash_later(self, file: FileImage):
+        # moved files are found in the hash storage by inode
+        if not self.target.hash_storage.apply_file(file):
+            self.hash_queue.put(file)
+
+    def _hash_loop(self):
+        while (file := self.hash_queue.get()) is not None:
+            try:
+                if _inode(os.stat(file.path, follow_symlinks=False)) != file.inode:
+                    continue  # changed again, the newer version is queued too
+                file_hash = hash_file(file.path, self.target.hash_algorithm)
+                file_stat = os.stat(file.path, follow_symlinks=False)
+            except OSError:
+                continue
+            with self.lock:
+                if _inode(file_stat) != file.inode:
+                    continue
+                file.hash = file_hash
+                file.hash_tier = HASH_FULL
+                self.target.hash_storage.add_file(file)
+                self.changed = True
+
+    def snapshot(self):
+        with self.lock:
+            image = self.target.image.pruned() or FolderImage('', [], [])
+            image.hash_algorithm = self.target.hash_algorithm
+            path = self.target.live_image_path()
+            tmp_path = path.with_suffix('.live.tmp')
+            with tmp_path.open('wb') as f:
+                # read often and lazily from a mapped file, so it isn't compressed
+                image.save(StructFile(f, str(tmp_path)), 'none')
+            tmp_path.replace(path)
+            self.target.save_hash_storage()
+            self.changed = False
+            self.last_snapshot = time()
+
+
+# files and subfolders of a folder are kept sorted by name, as FolderImage.image_dir makes them
+_name = attrgetter('name')
+
+
+def _index(children: list, name: str) -> int:
+    return bisect_left(children, name, key=_name)
+
+
+def _get_child(folder: FolderImage, name: str) -> Union[FileImage, FolderImage, None]:
+    for children in (folder.files, folder.folders):
+        i = _index(children, name)
+        if i < len(children) and children[i].name == name:
+            return children[i]
+    return None
+
+
+def watch_targets(targets: List[Target], interval: float):
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    watchers = []
+    try:
+        for target in targets:
+            print(f'Target {target.name}:')
+            watcher = Watcher(target, interval)
+            watchers.append(watcher)
+            watcher.start()
+            print(f'\rWatching {target.root}')
+
+        handlers = {}
+        for watcher in watchers:
+            handlers[watcher.inotify.fileno()] = watcher.handle_events
+            handlers[watcher.fifo] = watcher.handle_requests
+        while True:
+            ready, _, _ = select.select(list(handlers), [], [], interval)
+            for fd in ready:
+                handlers[fd]()
+            for watcher in watchers:
+                if watcher.changed and time() - watcher.last_snapshot >= interval:
+                    watcher.snapshot()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for watcher in watchers:
+            watcher.close()